@@ -1,14 +1,12 @@
 # Python standard libraries
-import json
 import os
+import tempfile
 
 # Third party libraries
 from flask import Flask
-from mongoengine import connect
+from pymongo import monitoring
 from flask_login import LoginManager
-#from oauthlib.oauth2 import WebApplicationClient
-import certifi
-from app.utils.secrets import getSecrets
+from app.utils.settings import setting
 from flask_moment import Moment
 import base64
 
@@ -17,7 +15,72 @@ app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY") or os.urandom(24)
 
 # Configuration
-secrets = getSecrets()
+# How many drawn sleep graphs to keep in memory
+app.config['GRAPH_CACHE_SIZE'] = int(os.environ.get('GRAPH_CACHE_SIZE', 256))
+# How many rows to show on each page of a list
+app.config['PAGE_SIZE'] = int(os.environ.get('PAGE_SIZE', 20))
+# How many logged in users to keep in memory and for how many seconds
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1000))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))
+# Calls to other websites: seconds to wait and how many open connections to keep
+app.config['HTTP_TIMEOUT'] = float(os.environ.get('HTTP_TIMEOUT', 5))
+app.config['HTTP_POOL_SIZE'] = int(os.environ.get('HTTP_POOL_SIZE', 20))
+# How many seconds to remember Google's login settings before getting them again
+app.config['OAUTH_DISCOVERY_TTL'] = int(os.environ.get('OAUTH_DISCOVERY_TTL', 3600))
+# Address lookups for the clinic map: 'nominatim' or 'stub', lookups per second, retries
+app.config['GEOCODER'] = os.environ.get('GEOCODER', 'nominatim')
+app.config['GEOCODE_RATE'] = float(os.environ.get('GEOCODE_RATE', 1))
+app.config['GEOCODE_RETRIES'] = int(os.environ.get('GEOCODE_RETRIES', 3))
+# How many questions are in a random puzzle
+app.config['PUZZLE_RANDOM_COUNT'] = int(os.environ.get('PUZZLE_RANDOM_COUNT', 3))
+# How many search results and tags to show on the forum
+app.config['SEARCH_RESULTS'] = int(os.environ.get('SEARCH_RESULTS', 50))
+app.config['TAG_FACETS'] = int(os.environ.get('TAG_FACETS', 20))
+# How many comments to show on a blog page and how deep replies can go
+app.config['COMMENT_PAGE_SIZE'] = int(os.environ.get('COMMENT_PAGE_SIZE', 200))
+app.config['COMMENT_MAX_DEPTH'] = int(os.environ.get('COMMENT_MAX_DEPTH', 8))
+# Changes to the database are sent to the background subscribers in batches of this
+# many, waiting at most this many seconds for a batch to fill. See utils/events.py
+app.config['EVENT_BATCH_SIZE'] = int(os.environ.get('EVENT_BATCH_SIZE', 100))
+app.config['EVENT_BATCH_WAIT'] = float(os.environ.get('EVENT_BATCH_WAIT', 0.5))
+# /metrics: the token needed to read it (blank means anyone can), how many recent
+# requests per route are used to spot N+1 queries and how steep counts as one, and
+# requests slower than this many milliseconds are logged (0 turns that off).
+# See utils/metrics.py
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+app.config['METRICS_SAMPLES'] = int(os.environ.get('METRICS_SAMPLES', 200))
+app.config['N_PLUS_ONE_SLOPE'] = float(os.environ.get('N_PLUS_ONE_SLOPE', 0.25))
+app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 0))
+# With several processes (gunicorn workers) each one saves its numbers in this folder
+# every METRICS_FLUSH_SECONDS and /metrics adds them all up. Blank means this process
+# is the only one. gunicorn.conf.py sets it.
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR', '')
+app.config['METRICS_FLUSH_SECONDS'] = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+# Profiling live requests: how often to pick one at random (0.01 is 1 in 100, 0 never),
+# the token for the "X-Profile" header that asks for one (blank turns the header off),
+# where to save them, how many to keep and how many milliseconds between samples.
+# See utils/profiler.py
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_TOKEN'] = os.environ.get('PROFILE_TOKEN', '')
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'puzzles-profiles'))
+app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', 50))
+app.config['PROFILE_INTERVAL_MS'] = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+# Rendered list pages: where to keep them (blank means in memory, or a redis:// url),
+# the most bytes to keep in memory and how many seconds they are kept. In memory each
+# gunicorn worker has its own copy, so with more than one worker use redis.
+# See utils/fragcache.py
+app.config['FRAGMENT_CACHE_URL'] = os.environ.get('FRAGMENT_CACHE_URL', '')
+app.config['FRAGMENT_CACHE_BYTES'] = int(os.environ.get('FRAGMENT_CACHE_BYTES', 16 * 1024 * 1024))
+app.config['FRAGMENT_CACHE_TTL'] = int(os.environ.get('FRAGMENT_CACHE_TTL', 600))
+# /sleep/stats: the hours of sleep a night that sleep debt is counted against and how
+# many weeks and months to show
+app.config['SLEEP_TARGET_HOURS'] = float(os.environ.get('SLEEP_TARGET_HOURS', 9))
+app.config['SLEEP_STATS_WEEKS'] = int(os.environ.get('SLEEP_STATS_WEEKS', 12))
+app.config['SLEEP_STATS_MONTHS'] = int(os.environ.get('SLEEP_STATS_MONTHS', 12))
+# How many students to show on the puzzle leaderboard
+app.config['LEADERBOARD_SIZE'] = int(os.environ.get('LEADERBOARD_SIZE', 10))
+# The most clinics the map will ask for at once
+app.config['MAP_MAX_CLINICS'] = int(os.environ.get('MAP_MAX_CLINICS', 500))
 
 # User session management setup
 # https://flask-login.readthedocs.io/en/latest
@@ -25,8 +88,40 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# Naive database setup
-connect(secrets['MONGO_DB_NAME'], host=secrets['MONGO_HOST'], tlsCAFile=certifi.where())
+# Count the queries each request makes. This has to happen before connect()
+from app.utils.querycount import QueryCounter
+monitoring.register(QueryCounter())
+# Time every request. See utils/metrics.py
+from app.utils import metrics
+# Profile some requests. See utils/profiler.py
+from app.utils import profiler
+
+# Database setup. The connection is only opened when it is first used so the app can
+# be loaded before the production server forks its workers. See utils/database.py
+app.config['MONGO_DB_NAME'] = setting('MONGO_DB_NAME', 'puzzles')
+app.config['MONGO_HOST'] = setting('MONGO_HOST')
+# MONGO_IN_MEMORY=1 keeps the whole database in this process's memory (with mongomock)
+# instead of connecting to MongoDB. It starts in no time, needs no network and nothing
+# is kept when the app stops, which is what tests and benchmarks want. MONGO_FIXTURES=1
+# fills it with made up students when the app starts. See utils/fixtures.py
+app.config['MONGO_IN_MEMORY'] = os.environ.get('MONGO_IN_MEMORY') == '1' or (app.config['MONGO_HOST'] or '').startswith('mongomock://')
+if app.config['MONGO_IN_MEMORY']:
+    app.config['MONGO_HOST'] = 'mongomock://localhost'
+# The emails of the users who can see the admin pages, separated by commas
+app.config['ADMIN_EMAILS'] = setting('ADMIN_EMAILS', '')
+# Connections each process keeps open, at most and at least
+app.config['MONGO_MAX_POOL_SIZE'] = int(os.environ.get('MONGO_MAX_POOL_SIZE', 50))
+app.config['MONGO_MIN_POOL_SIZE'] = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+# Milliseconds to wait: to connect, to find a server, for a query (0 means forever)
+# and for a free connection from the pool (0 means forever)
+app.config['MONGO_CONNECT_TIMEOUT_MS'] = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000))
+app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'] = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 10000))
+app.config['MONGO_SOCKET_TIMEOUT_MS'] = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 20000))
+app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS'] = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000))
+# Which servers reads go to: primary, primaryPreferred, secondary, secondaryPreferred or nearest
+app.config['MONGO_READ_PREFERENCE'] = os.environ.get('MONGO_READ_PREFERENCE', 'primary')
+from app.utils.database import connectDB
+connectDB()
 moment = Moment(app)
 
 def base64encode(img):
@@ -37,3 +132,15 @@ def base64encode(img):
 app.jinja_env.globals.update(base64encode=base64encode)
 
 from .routes import *
+from .cli import *
+
+# Building indexes when the app loads is opt-in. gunicorn builds them before it starts
+# its workers (see gunicorn.conf.py). Anywhere else run 'flask ensure-indexes' after
+# every deploy. See ensureIndexes() in classes/data.py
+if os.environ.get('MONGO_ENSURE_INDEXES') == '1':
+    from app.classes.data import ensureIndexes
+    ensureIndexes()
+# Only ever in memory. Seeding empties the database first.
+if os.environ.get('MONGO_FIXTURES') == '1' and app.config['MONGO_IN_MEMORY']:
+    from app.utils.fixtures import seedFixtures
+    seedFixtures()
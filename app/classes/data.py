@@ -4,23 +4,16 @@
 # fields have types like IntField, StringField etc.  This uses the Mongoengine Python Library. When 
 # you interact with the data you are creating an onject that is an instance of the class.
 
-from sys import getprofile
-from tokenize import String
-from typing import KeysView
-from xmlrpc.client import Boolean
-
-from setuptools import SetuptoolsDeprecationWarning
 from app import app
-from flask import flash
 from flask_login import UserMixin
-from mongoengine import FileField, EmailField, StringField, IntField, ReferenceField, DateTimeField, BooleanField, FloatField, CASCADE
-from flask_mongoengine import Document
+from mongoengine import FileField, EmailField, StringField, IntField, ReferenceField, DateTimeField, BooleanField, FloatField, PointField, ListField, EmbeddedDocument, EmbeddedDocumentListField, CASCADE
+# EventDocument is a mongoengine Document that announces every change so caches and
+# counters can keep up. See utils/events.py
+from app.utils.events import EventDocument
 import datetime as dt
-import jwt
-from time import time
 from bson.objectid import ObjectId
 
-class User(UserMixin, Document):
+class User(UserMixin, EventDocument):
     createdate = DateTimeField(defaultdefault=dt.datetime.utcnow)
     gid = StringField(sparse=True, unique=True)
     gname = StringField()
@@ -30,6 +23,9 @@ class User(UserMixin, Document):
     lname = StringField()
     email = EmailField()
     image = FileField()
+    # smaller copies of image. See utils/images.py
+    image_small = FileField()
+    image_medium = FileField()
     prononuns = StringField()
     adult_fname = StringField()
     adult_lname = StringField()
@@ -37,12 +33,20 @@ class User(UserMixin, Document):
     role = StringField()
     age = IntField()
     consent = BooleanField(default=False)
+    # Random puzzles: the shuffle this user is working through (see shuffledIndex() in
+    # puzzles.py), how far into it they are and how many questions it was made for
+    puzzle_seed = IntField()
+    puzzle_position = IntField(default=0)
+    puzzle_bank_size = IntField()
 
     meta = {
-        'ordering': ['lname','fname']
+        'ordering': ['lname','fname'],
+        # the login callback looks users up by email
+        'indexes': ['email'],
+        'auto_create_index': False
     }
 
-class Sleep(Document):
+class Sleep(EventDocument):
     sleeper = ReferenceField('User',reverse_delete_rule=CASCADE)
     rating = IntField()
     feel = IntField()
@@ -53,10 +57,13 @@ class Sleep(Document):
     minstosleep = IntField()
 
     meta = {
-        'ordering': ['sleep_date']
+        'ordering': ['sleep_date'],
+        # sleeps are always looked up for one sleeper, sorted by date or start time
+        'indexes': [('sleeper','sleep_date'), ('sleeper','start')],
+        'auto_create_index': False
     }
     
-class Blog(Document):
+class Blog(EventDocument):
     author = ReferenceField('User',reverse_delete_rule=CASCADE) 
     subject = StringField()
     content = StringField()
@@ -65,25 +72,55 @@ class Blog(Document):
     modify_date = DateTimeField()
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        'indexes': [
+            '-create_date',
+            # the list of blogs with one tag, newest first
+            ('tag', '-id'),
+            # /blogs/search. A '$' in front of a field puts it in the text index. A word
+            # in the subject counts for more than the same word in the content.
+            {
+                'fields': ['$subject', '$tag', '$content'],
+                'default_language': 'english',
+                'weights': {'subject': 10, 'tag': 5, 'content': 1}
+            }
+        ],
+        'auto_create_index': False
+    }
+
+# How many blogs have each tag. See utils/tags.py
+class TagCount(EventDocument):
+    tag = StringField(unique=True)
+    count = IntField(default=0)
+
+    meta = {
+        'indexes': ['-count'],
+        'auto_create_index': False
     }
 
-class Comment(Document):
+class Comment(EventDocument):
     # Line 63 is a way to access all the information in Course and Teacher w/o storing it in this class
     author = ReferenceField('User',reverse_delete_rule=CASCADE) 
     blog = ReferenceField('Blog',reverse_delete_rule=CASCADE)
-    # This could be used to allow comments on comments
+    # The comment this is a reply to, if it is a reply
     comment = ReferenceField('Comment',reverse_delete_rule=CASCADE)
+    # the ids of the comments this is a reply to and then its own id, like "id1/id2/id3".
+    # depth is how many comments it is under. See utils/commenttree.py
+    path = StringField()
+    depth = IntField(default=0)
     # Line 68 is where you store all the info you need but won't find in the Course and Teacher Object
     content = StringField()
     create_date = DateTimeField(default=dt.datetime.utcnow)
     modify_date = DateTimeField()
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        # the blog page gets all the comments for one blog sorted by path
+        'indexes': [('blog','path')],
+        'auto_create_index': False
     }
 
-class Clinic(Document):
+class Clinic(EventDocument):
     author = ReferenceField('User',reverse_delete_rule=CASCADE) 
     createdate = DateTimeField(default=dt.datetime.utcnow)
     modifydate = DateTimeField()
@@ -95,13 +132,29 @@ class Clinic(Document):
     description = StringField()
     lat = FloatField()
     lon = FloatField()
+    # the same spot as lat/lon stored as a GeoJSON point [lon, lat] so MongoDB can
+    # find the clinics near a spot or inside the part of the map being looked at
+    location = PointField(auto_index=False)
+    # 'pending' until the address has been looked up, then 'found', 'notfound' or 'failed'.
+    # Clinics saved before addresses were looked up in the background don't have one.
+    geostatus = StringField()
     
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-createdate'],
+        # '(location' is a 2dsphere index
+        'indexes': ['-createdate', '(location'],
+        'auto_create_index': False
     }
 
-class Response(Document):
+# Responses are how puzzles were saved before PuzzleSession. They are kept so old
+# links still work. 'flask migrate-responses' copies them into PuzzleSessions.
+class Response(EventDocument):
     author = ReferenceField('User',reverse_delete_rule=CASCADE)
+    # which puzzle set from puzzles.json, its questions and what the student answered
+    puzzleset = StringField()
+    questions = ListField(StringField())
+    answers = ListField(StringField())
+    # q1-q9 and a1-a9 are how responses were saved before puzzles.json
     q1 = StringField()
     q2 = StringField()
     q3 = StringField()
@@ -120,4 +173,89 @@ class Response(Document):
     a7 = StringField()
     a8 = StringField()
     a9 = StringField()
-    score = IntField()
\ No newline at end of file
+    score = IntField()
+
+    meta = {
+        'indexes': ['author'],
+        'auto_create_index': False
+    }
+
+# One answer to one question. It is stored inside a PuzzleSession, not on its own.
+class Attempt(EmbeddedDocument):
+    # the puzzle set the question was in and the question's id in puzzles.json
+    puzzleset = StringField()
+    question = StringField()
+    q = StringField()
+    answer = StringField()
+    correct = BooleanField()
+    create_date = DateTimeField(default=dt.datetime.utcnow)
+
+# All the puzzles a student answers until they click Finish are one PuzzleSession.
+# Each puzzle page adds its answers to the end of attempts and adds its points to
+# score in one update, so the score is always ready without adding anything up.
+class PuzzleSession(EventDocument):
+    author = ReferenceField('User',reverse_delete_rule=CASCADE)
+    open = BooleanField(default=True)
+    attempts = EmbeddedDocumentListField(Attempt)
+    score = IntField(default=0)
+    create_date = DateTimeField(default=dt.datetime.utcnow)
+    modify_date = DateTimeField()
+
+    meta = {
+        'ordering': ['-create_date'],
+        'indexes': [
+            # a student can only have one open session
+            {'fields': ['author'], 'unique': True, 'partialFilterExpression': {'open': True}},
+            ('author', '-create_date'),
+            # finding a student's best session after one is deleted
+            ('author', '-score')
+        ],
+        'auto_create_index': False
+    }
+
+# Running totals for each student. They are added to every time a student answers a
+# puzzle so the leaderboard never has to add up every PuzzleSession.
+class PuzzleStats(EventDocument):
+    user = ReferenceField('User',reverse_delete_rule=CASCADE,unique=True)
+    sessions = IntField(default=0)
+    attempts = IntField(default=0)
+    correct = IntField(default=0)
+    best_score = IntField(default=0)
+
+    meta = {
+        # the leaderboard is the top students by correct answers
+        'indexes': [('-correct', '-best_score')],
+        'auto_create_index': False
+    }
+
+# How soon the next request to a rate limited website may be sent. It is kept in
+# MongoDB so every gunicorn worker waits its turn. See SharedRateLimiter in utils/geocode.py
+class RateLimit(EventDocument):
+    name = StringField(primary_key=True)
+    next = DateTimeField()
+
+    meta = {
+        'auto_create_index': False
+    }
+
+# The answers from the address lookup for the map. See utils/geocode.py
+class Geocode(EventDocument):
+    address = StringField(unique=True)
+    found = BooleanField()
+    lat = FloatField()
+    lon = FloatField()
+    createdate = DateTimeField(default=dt.datetime.utcnow)
+
+    meta = {
+        'auto_create_index': False
+    }
+
+# Every collection. Used to build the indexes and to fill or empty a test database.
+allDocuments = (User, Sleep, Blog, Comment, Clinic, Response, PuzzleSession, PuzzleStats, Geocode, TagCount, RateLimit)
+
+# Indexes are not built automatically when the app starts because building them on a
+# big collection is slow. Run 'flask ensure-indexes' once after changing an index above
+# or start the app with MONGO_ENSURE_INDEXES=1.
+def ensureIndexes():
+    for document in allDocuments:
+        document.ensure_indexes()
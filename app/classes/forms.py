@@ -6,7 +6,7 @@ from flask_wtf import FlaskForm
 import mongoengine.errors
 from wtforms.validators import URL, Email, DataRequired, NumberRange
 from wtforms.fields.html5 import URLField, DateField, IntegerRangeField, EmailField
-from wtforms import StringField, SubmitField, TextAreaField, IntegerField, SelectField, FileField, RadioField
+from wtforms import StringField, SubmitField, TextAreaField, IntegerField, SelectField, FileField, RadioField, HiddenField
 from wtforms_components import TimeField
 
 class ProfileForm(FlaskForm):
@@ -55,23 +55,12 @@ class ClinicForm(FlaskForm):
     description = StringField('Description', validators=[DataRequired()])
     submit = SubmitField('Submit')
 
-class ResponseForm(FlaskForm):
-    q1 = StringField()
-    q2 = StringField()
-    q3 = StringField()
-    q4 = StringField()
-    q5 = StringField()
-    q6 = StringField()
-    q7 = StringField()
-    q8 = StringField()
-    q9 = StringField()
-    a1 = StringField()
-    a2 = StringField()
-    a3 = StringField()
-    a4 = StringField()
-    a5 = StringField()
-    a6 = StringField()
-    a7 = StringField()
-    a8 = StringField()
-    a9 = StringField()
-    submit = SubmitField('Solve')
\ No newline at end of file
+# A puzzle can have any number of questions so its form is made when it is needed.
+# There is one answer field (a0, a1, a2...) for each question, labeled with the question.
+# position is for random puzzles, it is sent back to make sure the student is answering
+# the questions they were shown.
+def puzzleForm(questions, position=None):
+    fields = {f'a{i}': StringField(question.q) for i, question in enumerate(questions)}
+    fields['position'] = HiddenField(default=position)
+    fields['submit'] = SubmitField('Solve')
+    return type('PuzzleForm', (FlaskForm,), fields)()
@@ -0,0 +1,129 @@
+# The puzzle questions live in puzzles.json, not in the code. To add a question, add
+# it to "questions" with an id, the question "q" and the right answers "a". To make a
+# new puzzle, add a set to "sets" with the ids of its questions. A set can have any
+# number of questions and the /puzzle/<setID> route will show it.
+#
+# Answers only need to be listed once. Both the right answers and the student's answer
+# are "normalized" before they are compared: capitals, extra spaces and punctuation
+# don't matter and number words count as numbers, so "Two", "two " and "2" all match
+# "2". The right answers are normalized once when the app starts and kept in a set,
+# so checking an answer is one lookup no matter how many right answers there are.
+
+import hashlib
+import json
+import os
+import re
+
+numberWords = {
+    'zero': 0, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6,
+    'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10, 'eleven': 11, 'twelve': 12,
+    'thirteen': 13, 'fourteen': 14, 'fifteen': 15, 'sixteen': 16, 'seventeen': 17,
+    'eighteen': 18, 'nineteen': 19, 'twenty': 20, 'thirty': 30, 'forty': 40,
+    'fifty': 50, 'sixty': 60, 'seventy': 70, 'eighty': 80, 'ninety': 90,
+}
+
+def normalizeAnswer(text):
+    text = re.sub(r"[^\w\s]", " ", (text or "").casefold())
+    words = []
+    for word in text.replace("_", " ").split():
+        number = numberWords.get(word)
+        # "twenty one" becomes 21
+        if number is not None and number < 10 and words and isinstance(words[-1], int) \
+                and words[-1] >= 20 and words[-1] % 10 == 0:
+            words[-1] += number
+        elif number is not None:
+            words.append(number)
+        else:
+            words.append(word)
+    return " ".join(str(word) for word in words)
+
+# Where the question at position in a shuffled list of size questions comes from.
+# Every seed is a different shuffle and every position gives a different question, so
+# walking position 0, 1, 2... never repeats a question until all of them have been
+# used. It works without making the shuffled list so it is just as fast for a bank of
+# a million questions. (It is a small Feistel cipher, look it up if you are curious!)
+def shuffledIndex(position, size, seed):
+    halfBits = max(1, ((size - 1).bit_length() + 1) // 2)
+    mask = (1 << halfBits) - 1
+    value = position
+    while True:
+        left, right = value >> halfBits, value & mask
+        for round in range(4):
+            digest = hashlib.blake2b(f"{seed}:{round}:{right}".encode('utf-8'), digest_size=8).digest()
+            left, right = right, left ^ (int.from_bytes(digest, 'big') & mask)
+        value = (left << halfBits) | right
+        # the cipher mixes up a range that can be a bit bigger than size, so
+        # keep going until it lands inside it
+        if value < size:
+            return value
+
+class Question:
+    def __init__(self, id, q, answers):
+        self.id = id
+        self.q = q
+        self.answers = frozenset(normalizeAnswer(answer) for answer in answers)
+
+    def check(self, answer):
+        return normalizeAnswer(answer) in self.answers
+
+class PuzzleSet:
+    def __init__(self, id, title, questions):
+        self.id = id
+        self.title = title
+        self.questions = questions
+
+class PuzzleBank:
+    def __init__(self, data):
+        # questions and sets are looked up by their id
+        self.questions = {}
+        for question in data['questions']:
+            if question['id'] in self.questions:
+                raise ValueError(f"Puzzle question id '{question['id']}' is used twice")
+            self.questions[question['id']] = Question(question['id'], question['q'], question['a'])
+        # every question in the order they are in the file, used for random puzzles
+        self.order = list(self.questions.values())
+
+        self.sets = {}
+        for puzzleSet in data['sets']:
+            missing = [id for id in puzzleSet['questions'] if id not in self.questions]
+            if missing:
+                raise ValueError(f"Puzzle set '{puzzleSet['id']}' uses questions that don't exist: {missing}")
+            self.sets[puzzleSet['id']] = PuzzleSet(puzzleSet['id'], puzzleSet['title'],
+                [self.questions[id] for id in puzzleSet['questions']])
+
+    # count questions starting at position in the shuffle made from seed
+    def shuffled(self, seed, position, count):
+        size = len(self.order)
+        return [self.order[shuffledIndex(position + i, size, seed)] for i in range(count)]
+
+    # The next count questions for a student who is at position in the shuffle made
+    # from seed, and the seed and position they are at after answering them. When the
+    # shuffle has fewer than count questions left those come first and the rest come
+    # from the next shuffle (skipping any that are already on this page), so every
+    # question is asked once before any question is asked again. The next shuffle's
+    # seed comes from this one, so the same seed and position always give the same page.
+    def nextQuestions(self, seed, position, count):
+        size = len(self.order)
+        count = min(count, size)
+        questions = self.shuffled(seed, position, max(0, min(count, size - position)))
+        position += len(questions)
+        if len(questions) < count:
+            seed, position = nextSeed(seed), 0
+            onPage = {question.id for question in questions}
+            while len(questions) < count:
+                question = self.order[shuffledIndex(position, size, seed)]
+                position += 1
+                if question.id not in onPage:
+                    questions.append(question)
+        return questions, seed, position
+
+# The seed of the shuffle that comes after the one made from seed
+def nextSeed(seed):
+    digest = hashlib.blake2b(f"next:{seed}".encode('utf-8'), digest_size=4).digest()
+    return int.from_bytes(digest, 'big') & 0x7fffffff
+
+def loadPuzzleBank(path):
+    with open(path, encoding='utf-8') as file:
+        return PuzzleBank(json.load(file))
+
+puzzleBank = loadPuzzleBank(os.environ.get('PUZZLE_BANK') or os.path.join(os.path.dirname(__file__), 'puzzles.json'))
@@ -0,0 +1,206 @@
+# These are commands you run in the terminal instead of in the browser. Flask needs
+# to know where the app is so set FLASK_APP first:
+#     set FLASK_APP=main          (Mac: export FLASK_APP=main)
+#     flask ensure-indexes
+#     flask explain-queries
+
+import click
+import datetime as dt
+from bson.objectid import ObjectId
+from mongoengine import Q
+from app import app
+from app.utils.events import events
+from app.classes.data import User, Sleep, Blog, Comment, Clinic, Response, PuzzleSession, PuzzleStats, Attempt, TagCount, ensureIndexes
+
+@app.cli.command('ensure-indexes')
+def ensureIndexesCommand():
+    # Builds every index declared in the 'meta' of the classes in data.py
+    ensureIndexes()
+    click.echo("Indexes are up to date.")
+
+@app.cli.command('backfill-clinic-locations')
+def backfillClinicLocationsCommand():
+    # Clinics saved before Clinic.location existed only have lat/lon
+    count = 0
+    for clinic in Clinic.objects(location__exists=False, lat__exists=True, lon__exists=True).only('lat','lon'):
+        clinic.update(location=[clinic.lon, clinic.lat])
+        count += 1
+    click.echo(f"Added a location to {count} clinics.")
+
+@app.cli.command('geocode-clinics')
+@click.option('--all', 'everything', is_flag=True, help="also the clinics whose address wasn't found")
+def geocodeClinicsCommand(everything):
+    # Looks up the clinics whose lookup never finished: the queue in utils/geocode.py
+    # is in memory, so a worker restarting drops what was waiting in it. Also older
+    # clinics that were never looked up at all. This waits for every lookup.
+    from app.utils.geocode import geocodeClinic, makeGeocoder
+    statuses = ['pending', 'failed', 'notfound'] if everything else ['pending', 'failed']
+    waiting = Clinic.objects(geostatus__in=statuses).only('id')
+    neverLooked = Clinic.objects(geostatus=None, location__exists=False).only('id')
+    geocoder = makeGeocoder()
+    count = 0
+    for clinic in list(waiting) + list(neverLooked):
+        # with --all the addresses that weren't found are asked about again
+        geocodeClinic(clinic.id, geocoder, refresh=everything)
+        count += 1
+    click.echo(f"Looked up {count} clinics.")
+
+@app.cli.command('migrate-responses')
+def migrateResponsesCommand():
+    # Copies each old Response into a finished PuzzleSession with the same id, so
+    # running this twice doesn't copy anything twice
+    count = 0
+    for response in Response.objects().no_dereference():
+        if PuzzleSession.objects(id=response.id).count():
+            continue
+        if response.questions:
+            pairs = zip(response.questions, response.answers)
+        else:
+            pairs = [(response[f'q{i}'], response[f'a{i}']) for i in range(1, 10) if response[f'q{i}']]
+        PuzzleSession(
+            id = response.id,
+            author = response.author,
+            open = False,
+            attempts = [Attempt(puzzleset=response.puzzleset, q=q, answer=a, create_date=response.id.generation_time)
+                for q, a in pairs],
+            score = response.score or 0,
+            create_date = response.id.generation_time,
+        ).save(force_insert=True)
+        count += 1
+    click.echo(f"Copied {count} responses into puzzle sessions.")
+
+@app.cli.command('rebuild-puzzle-stats')
+def rebuildPuzzleStatsCommand():
+    # Adds the leaderboard totals up from scratch, for after migrate-responses
+    # or if the totals ever get out of step with the sessions
+    PuzzleStats.objects().delete()
+    totals = PuzzleSession.objects().aggregate([
+        {'$group': {
+            '_id': '$author',
+            'sessions': {'$sum': 1},
+            'attempts': {'$sum': {'$size': {'$ifNull': ['$attempts', []]}}},
+            'correct': {'$sum': '$score'},
+            'best_score': {'$max': '$score'}
+        }}
+    ])
+    count = 0
+    for total in totals:
+        PuzzleStats(user=total['_id'], sessions=total['sessions'], attempts=total['attempts'],
+            correct=total['correct'], best_score=total['best_score']).save()
+        count += 1
+    click.echo(f"Rebuilt puzzle totals for {count} students.")
+
+@app.cli.command('fix-sleep-hours')
+def fixSleepHoursCommand():
+    # New sleeps used to work out their hours backwards (start - end instead of end -
+    # start), which gives 24 minus the real hours. This works them out again.
+    count = 0
+    for sleep in Sleep.objects(start__exists=True, end__exists=True).only('start','end','hours'):
+        if not sleep.start or not sleep.end:
+            continue
+        hours = (sleep.end - sleep.start).seconds/60/60
+        if sleep.hours is None or abs(sleep.hours - hours) > 0.01:
+            sleep.update(hours=hours)
+            count += 1
+    click.echo(f"Fixed the hours of {count} sleeps.")
+
+@app.cli.command('backfill-comment-paths')
+def backfillCommentPathsCommand():
+    # Comments saved before Comment.path existed are all comments on the blog itself
+    count = Comment.objects(path__exists=False).count()
+    for comment in Comment.objects(path__exists=False).only('id'):
+        comment.update(path=str(comment.id), depth=0)
+    click.echo(f"Added a path to {count} comments.")
+
+@app.cli.command('rebuild-tag-counts')
+def rebuildTagCountsCommand():
+    # Normally the blog routes keep TagCount up to date. This counts every blog again
+    # (after an import, or blogs that were saved before tags were counted).
+    from app.utils.tags import normalizeTag
+    for blog in Blog.objects().only('id', 'tag'):
+        if blog.tag != normalizeTag(blog.tag):
+            blog.update(tag=normalizeTag(blog.tag))
+    # let the tag counter finish with those changes before counting from scratch
+    events.flush()
+    TagCount.objects().delete()
+    totals = Blog.objects(tag__nin=[None, '']).aggregate([
+        {'$group': {'_id': '$tag', 'count': {'$sum': 1}}}
+    ])
+    count = 0
+    for total in totals:
+        TagCount(tag=total['_id'], count=total['count']).save()
+        count += 1
+    click.echo(f"Counted blogs for {count} tags.")
+
+# These are the queries the routes run the most. If one of them ever stops using
+# an index MongoDB has to read the whole collection (a COLLSCAN) to answer it.
+def hotQueries():
+    someId = ObjectId()
+    return {
+        'callback: User by email': User.objects(email='someone@ousd.org'),
+        'blogList: a page of Blogs': Blog.objects().order_by('-id'),
+        'blogList: a page of Blogs with a tag': Blog.objects(tag='homework').order_by('-id'),
+        'blogSearch: Blogs with a word': Blog.objects.search_text('sleep').order_by('$text_score'),
+        'blogList: the most used tags': TagCount.objects().order_by('-count'),
+        'blog: Comments for a Blog': Comment.objects(Q(depth__lte=app.config['COMMENT_MAX_DEPTH']) | Q(depth__exists=False), blog=someId).order_by('path'),
+        'sleepgraph: Sleeps for a sleeper': Sleep.objects(sleeper=someId).order_by('start'),
+        'sleeps: Sleeps for a sleeper by date': Sleep.objects(sleeper=someId),
+        'sleepStatsPage: Sleeps for a sleeper since a date': Sleep.objects(sleeper=someId, sleep_date__gte=dt.datetime(2024, 1, 1)),
+        'sleeps: a page of Sleeps': Sleep.objects().order_by('-id'),
+        'clinicList: a page of Clinics': Clinic.objects().order_by('-id'),
+        'clinicNearest: Clinics near a spot': Clinic.objects(location__near=[-122.25, 37.83]),
+        'clinicWithin: Clinics on the map': Clinic.objects(location__geo_within={'type': 'MultiPolygon',
+            'coordinates': [[[[-122.4, 37.7], [-122.1, 37.7], [-122.1, 37.9], [-122.4, 37.9], [-122.4, 37.7]]]]}),
+        'recordAttempts: open PuzzleSession for a user': PuzzleSession.objects(author=someId, open=True),
+        'responseList: a page of PuzzleSessions': PuzzleSession.objects().order_by('-id'),
+        'puzzleLeaderboard: top students': PuzzleStats.objects().order_by('-correct', '-best_score'),
+    }
+
+def findStages(plan):
+    stages = [plan.get('stage')]
+    for child in plan.get('inputStages', []) + [plan.get('inputStage', {})]:
+        if child:
+            stages += findStages(child)
+    return stages
+
+# Asks MongoDB how it would answer each hot query. Returns {name: [its stages]}.
+# The in memory database (MONGO_IN_MEMORY) can't explain queries.
+def explainHotQueries():
+    plans = {}
+    for name, query in hotQueries().items():
+        plan = query.explain()['queryPlanner']['winningPlan']
+        # newer MongoDB versions wrap the plan one level deeper
+        plan = plan.get('queryPlan', plan)
+        plans[name] = [stage for stage in findStages(plan) if stage]
+    return plans
+
+# This is a command and not a test because the app has no test suite. It exits with
+# 1 if any hot query would scan a whole collection, so a deploy script or CI can run
+# it against a database with the indexes built. gunicorn also runs the same check
+# every time it starts and logs a warning (see gunicorn.conf.py).
+@app.cli.command('explain-queries')
+def explainQueriesCommand():
+    scans = 0
+    for name, stages in explainHotQueries().items():
+        if 'COLLSCAN' in stages:
+            scans += 1
+            click.echo(f"COLLSCAN  {name}")
+        else:
+            click.echo(f"ok        {name}: {' <- '.join(stages)}")
+    if scans:
+        raise SystemExit(1)
+
+@app.cli.command('seed-fixtures')
+@click.option('--users', default=20, help='how many students')
+@click.option('--blogs', default=100, help='how many blogs')
+@click.option('--seed', default=1, help='the same seed always makes the same data')
+def seedFixturesCommand(users, blogs, seed):
+    # Empties EVERY collection and fills them with made up data. See utils/fixtures.py
+    # An in memory database is gone as soon as this command ends, so for that start
+    # the app with MONGO_FIXTURES=1 instead.
+    from app.utils.fixtures import seedFixtures
+    if app.config['MONGO_IN_MEMORY']:
+        raise click.ClickException("The in memory database doesn't outlive this command. Use MONGO_FIXTURES=1.")
+    click.confirm(f"This deletes everything in the {app.config['MONGO_DB_NAME']} database. Go on?", abort=True)
+    counts = seedFixtures(users=users, blogs=blogs, seed=seed)
+    click.echo(', '.join(f"{len(value) if isinstance(value, list) else value} {name}" for name, value in counts.items()))
@@ -4,4 +4,6 @@ from .forum import *
 from .user import *
 from .sleep import *
 from .clinic import *
-from .responses import *
\ No newline at end of file
+from .responses import *
+from .metrics import *
+from .profiles import *
\ No newline at end of file
@@ -1,30 +1,103 @@
 from app import app
-from app.utils.secrets import getSecrets
-import requests
-from flask import render_template, flash, redirect, url_for
-import requests
+from flask import render_template, flash, redirect, url_for, request, jsonify
 from flask_login import current_user
 from app.classes.data import Clinic
 from app.classes.forms import ClinicForm
 from flask_login import login_required
+from app.utils.pagination import paginate
+from app.utils.fragcache import fragmentCache
+from app.utils.geocode import geocodeQueue, normalizeAddress
+from pymongo.errors import OperationFailure
 import datetime as dt
 
 
 @app.route('/clinic/map')
 @login_required
 def clinicMap():
-
-    clinics = Clinic.objects()
-
-    return render_template('cliniclocator.html',clinics=clinics)
+    # The map asks /clinic/within for the clinics it is showing whenever it moves
+    return render_template('cliniclocator.html')
+
+# Only the fields the map popups show
+mapFields = ['name','streetAddress','city','state','zipcode','description','location']
+
+def clinicsJson(clinics):
+    return jsonify([{
+        'id': str(clinic['_id']),
+        'name': clinic.get('name'),
+        'streetAddress': clinic.get('streetAddress'),
+        'city': clinic.get('city'),
+        'state': clinic.get('state'),
+        'zipcode': clinic.get('zipcode'),
+        'description': clinic.get('description'),
+        'lat': clinic['location']['coordinates'][1],
+        'lon': clinic['location']['coordinates'][0],
+    } for clinic in clinics])
+
+# /clinic/nearest?lat=37.83&lon=-122.25&n=10 is the 10 closest clinics, closest first
+@app.route('/clinic/nearest')
+@login_required
+def clinicNearest():
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        n = min(int(request.args.get('n', 10)), app.config['MAP_MAX_CLINICS'])
+    except (KeyError, ValueError):
+        return jsonify(error="lat and lon are required and must be numbers"), 400
+    try:
+        clinics = list(Clinic.objects(location__near=[lon, lat]).only(*mapFields).limit(n).as_pymongo())
+    except (OperationFailure, NotImplementedError):
+        # $near only works with the 2dsphere index (see 'flask ensure-indexes') and the
+        # in memory database (MONGO_IN_MEMORY) doesn't have it at all
+        app.logger.exception("Nearest clinics search failed")
+        return jsonify(error="Finding the nearest clinics isn't working right now"), 503
+    return clinicsJson(clinics)
+
+# /clinic/within?south=37.7&west=-122.4&north=37.9&east=-122.1 is the clinics inside
+# that box, which is the part of the map the user is looking at
+@app.route('/clinic/within')
+@login_required
+def clinicWithin():
+    try:
+        south, west, north, east = [float(request.args[side]) for side in ('south','west','north','east')]
+    except (KeyError, ValueError):
+        return jsonify(error="south, west, north and east are required and must be numbers"), 400
+
+    south, north = max(south, -90), min(north, 90)
+    if east - west >= 180 or north - south >= 90:
+        # zoomed out to most of the world, MongoDB can't search a box that big
+        clinics = Clinic.objects(location__exists=True)
+    else:
+        # After the map is dragged sideways past the date line it sends longitudes like
+        # 190 or -200. Move west back to between -180 and 180 and keep the same width.
+        # If the box then goes past 180 it is cut in two: up to 180 and from -180.
+        width = east - west
+        west = ((west + 180) % 360) - 180
+        east = west + width
+        if east <= 180:
+            sides = [(west, east)]
+        else:
+            sides = [(west, 180), (-180, east - 360)]
+        boxes = [[[[w, south], [e, south], [e, north], [w, north], [w, south]]] for w, e in sides]
+        # geo_within with a GeoJSON polygon is the kind of search a 2dsphere index can answer
+        clinics = Clinic.objects(location__geo_within={'type': 'MultiPolygon', 'coordinates': boxes})
+    try:
+        clinics = list(clinics.only(*mapFields).limit(app.config['MAP_MAX_CLINICS']).as_pymongo())
+    except (OperationFailure, NotImplementedError):
+        # the same as clinicNearest: $geoWithin on a GeoJSON shape needs the 2dsphere
+        # index and the in memory database (MONGO_IN_MEMORY) doesn't have it at all
+        app.logger.exception("Clinics in the map box search failed")
+        return jsonify(error="Finding the clinics on the map isn't working right now"), 503
+    return clinicsJson(clinics)
 
 @app.route('/clinic/list')
 @login_required
 def clinicList():
-
-    clinics = Clinic.objects()
-
-    return render_template('clinics.html',clinics=clinics)
+    # only run when this page isn't in the fragment cache. See utils/fragcache.py
+    def load():
+        page = paginate(Clinic.objects())
+        return dict(clinics=page.items,page=page)
+    rows = fragmentCache.render('clinics', 'includes/_clinicsrows.html', load)
+    return render_template('clinics.html',rows=rows)
 
 
 @app.route('/clinic/<clinicID>')
@@ -45,32 +118,6 @@ def clinicDelete(clinicID):
     flash('The Clinic was deleted.')
     return redirect(url_for('clinicList'))
 
-def updateLatLon(clinic):
-    # get your email address for the secrets file
-    secrets=getSecrets()
-    # call the maps API with the address
-    url = f"https://nominatim.openstreetmap.org/search?street={clinic.streetAddress}&city={clinic.city}&state={clinic.state}&postalcode={clinic.zipcode}&format=json&addressdetails=1&email={secrets['MY_EMAIL_ADDRESS']}"
-    # get the response from the API
-    r = requests.get(url)
-    # Find the lat/lon in the response
-    try:
-        r = r.json()
-    except:
-        flash("unable to retrieve lat/lon")
-        return(clinic)
-    else:
-        if len(r) != 0:
-            # update the database
-            clinic.update(
-                lat = float(r[0]['lat']),
-                lon = float(r[0]['lon'])
-            )
-            flash(f"clinic lat/lon updated")
-            return(clinic)
-        else:
-            flash('unable to retrieve lat/lon')
-            return(clinic)
-
 @app.route('/clinic/new', methods=['GET', 'POST'])
 @login_required
 def clinicNew():
@@ -87,12 +134,13 @@ def clinicNew():
             description = form.description.data,
             author = current_user.id,
             modifydate = dt.datetime.utcnow,
+            geostatus = 'pending',
         )
         newClinic.save()
 
-        newClinic = updateLatLon(newClinic)
-
-        import requests
+        # The lat/lon is looked up in the background. See utils/geocode.py
+        geocodeQueue.add(newClinic)
+        flash("The clinic's address is being looked up for the map.")
 
         return redirect(url_for('clinic',clinicID=newClinic.id))
 
@@ -109,6 +157,8 @@ def clinicEdit(clinicID):
 
     form = ClinicForm()
     if form.validate_on_submit():
+        oldAddress = normalizeAddress(editClinic.streetAddress, editClinic.city, editClinic.state, editClinic.zipcode)
+        newAddress = normalizeAddress(form.streetAddress.data, form.city.data, form.state.data, form.zipcode.data)
         editClinic.update(
             name = form.name.data,
             streetAddress = form.streetAddress.data,
@@ -118,7 +168,13 @@ def clinicEdit(clinicID):
             description = form.description.data,
             modifydate = dt.datetime.utcnow,
         )
-        editClinic = updateLatLon(editClinic)
+        # Only look the address up again if it changed or the last lookup didn't work.
+        # For the same address that wasn't found, ask again instead of reading the
+        # saved "not found".
+        if oldAddress != newAddress or editClinic.geostatus != 'found':
+            editClinic.update(geostatus='pending')
+            geocodeQueue.add(editClinic, refresh=oldAddress == newAddress)
+            flash("The clinic's address is being looked up for the map.")
         return redirect(url_for('clinic',clinicID=clinicID))
 
     form.name.data = editClinic.name
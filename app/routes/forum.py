@@ -4,11 +4,19 @@
 
 from app import app
 import mongoengine.errors
-from flask import render_template, flash, redirect, url_for
+from mongoengine import Q
+from flask import render_template, flash, redirect, url_for, request
 from flask_login import current_user
-from app.classes.data import Blog, Comment
+from app.classes.data import Blog, Comment, User
 from app.classes.forms import BlogForm, CommentForm
 from flask_login import login_required
+from app.utils.pagination import paginate
+from app.utils.loaders import attachReferences
+from app.utils.commenttree import buildCommentTree, commentPath
+from app.utils.tags import normalizeTag, topTags
+from app.utils.fragcache import fragmentCache
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
 import datetime as dt
 
 # This is the route to list all blogs
@@ -17,13 +25,53 @@ import datetime as dt
 # This means the user must be logged in to see this page
 @login_required
 def blogList():
-    # This retrieves all of the 'blogs' that are stored in MongoDB and places them in a
-    # mongoengine object as a list of dictionaries name 'blogs'.
-    blogs = Blog.objects()
-    # This renders (shows to the user) the blogs.html template. it also sends the blogs object 
-    # to the template as a variable named blogs.  The template uses a for loop to display
-    # each blog.
-    return render_template('blogs.html',blogs=blogs)
+    # ?tag= shows only the blogs with that tag
+    tag = normalizeTag(request.args.get('tag'))
+    # load() is only run when this page of the list isn't already in the fragment cache.
+    # See utils/fragcache.py
+    def load():
+        blogs = Blog.objects(tag=tag) if tag else Blog.objects()
+        # This retrieves one page of the 'blogs' that are stored in MongoDB. page.items is a
+        # list of the blogs on this page. See utils/pagination.py for how pages work.
+        page = paginate(blogs)
+        # get the authors of all the blogs on this page in one query. See utils/loaders.py
+        attachReferences(page.items, 'author', User, only=['fname','lname'])
+        # The template uses a for loop to display each blog. The page is sent too so the
+        # template can show Newer/Older links.
+        return dict(blogs=page.items,page=page,pagerArgs={'tag': tag} if tag else {})
+    rows = fragmentCache.render('blogs', 'includes/_blogsrows.html', load)
+    # This renders (shows to the user) the blogs.html template with the rows of blogs in it.
+    return render_template('blogs.html',rows=rows,tag=tag,tags=topTags(app.config['TAG_FACETS']))
+
+# Search the subject, tag and content of every blog. The text index (see Blog in data.py)
+# finds the blogs with the words without reading all the blogs and gives each one a
+# score for how well it matches. The best matches are shown first.
+@app.route('/blogs/search')
+@login_required
+def blogSearch():
+    q = request.args.get('q', '').strip()
+    tag = normalizeTag(request.args.get('tag'))
+    blogs = []
+    if q:
+        if app.config['MONGO_IN_MEMORY']:
+            # the in memory database (MONGO_IN_MEMORY) doesn't have text search at all,
+            # so it looks for the words the slow way and shows the newest first
+            results = Blog.objects(Q(subject__icontains=q) | Q(content__icontains=q) | Q(tag=normalizeTag(q))).order_by('-create_date')
+        else:
+            results = Blog.objects.search_text(q).order_by('$text_score')
+        if tag:
+            results = results.filter(tag=tag)
+        # only the best matches are shown so a common word doesn't load the whole forum
+        try:
+            blogs = list(results.limit(app.config['SEARCH_RESULTS']))
+        except OperationFailure:
+            # text search only works with the text index (see 'flask ensure-indexes')
+            app.logger.exception("Blog search failed")
+            flash("Search isn't working right now. Try the tags instead.")
+            blogs = []
+        attachReferences(blogs, 'author', User, only=['fname','lname'])
+    return render_template('blogsearch.html',blogs=blogs,q=q,tag=tag,
+        tags=topTags(app.config['TAG_FACETS']))
 
 # This route will get one specific blog and any comments associated with that blog.  
 # The blogID is a variable that must be passsed as a parameter to the function and 
@@ -41,9 +89,26 @@ def blog(blogID):
     # there is a field on the comment collection called 'blog' that is a reference the Blog
     # document it is related to.  You can use the blogID to get the blog and then you can use
     # the blog object (thisBlog in this case) to get all the comments.
-    theseComments = Comment.objects(blog=thisBlog)
-    # Send the blog object and the comments object to the 'blog.html' template.
-    return render_template('blog.html',blog=thisBlog,comments=theseComments)
+    # Sorting by path puts every reply right after the comment it answers. A very long
+    # discussion is shown a page at a time: ?after= is the path of the last comment shown.
+    # See utils/commenttree.py
+    # Comments saved before depth and path existed don't have them. They are comments
+    # on the blog itself, so they count as depth 0 and, with no path, come first.
+    # 'flask backfill-comment-paths' gives them a path.
+    shallow = Q(depth__lte=app.config['COMMENT_MAX_DEPTH']) | Q(depth__exists=False)
+    theseComments = Comment.objects(shallow, blog=thisBlog).order_by('path')
+    if request.args.get('after'):
+        theseComments = theseComments.filter(path__gt=request.args['after'])
+    theseComments = list(theseComments.limit(app.config['COMMENT_PAGE_SIZE'] + 1))
+    morePath = None
+    if len(theseComments) > app.config['COMMENT_PAGE_SIZE']:
+        theseComments = theseComments[:-1]
+        morePath = theseComments[-1].path
+    # get the authors of all the comments in one query. See utils/loaders.py
+    attachReferences(theseComments, 'author', User, only=['username'])
+    # Send the blog object and the comments, arranged as replies under the comment they
+    # answer, to the 'blog.html' template.
+    return render_template('blog.html',blog=thisBlog,comments=buildCommentTree(theseComments),morePath=morePath)
 
 # This route will delete a specific blog.  You can only delete the blog if you are the author.
 # <blogID> is a variable sent to this route by the user who clicked on the trash can in the 
@@ -65,10 +130,8 @@ def blogDelete(blogID):
     else:
         # if the user is not the author tell them they were denied.
         flash("You can't delete a blog you don't own.")
-    # Retrieve all of the remaining blogs so that they can be listed.
-    blogs = Blog.objects()  
     # Send the user to the list of remaining blogs.
-    return render_template('blogs.html',blogs=blogs)
+    return redirect(url_for('blogList'))
 
 # This route actually does two things depending on the state of the if statement 
 # 'if form.validate_on_submit()'. When the route is first called, the form has not 
@@ -97,7 +160,7 @@ def blogNew():
             # the right side is the data the user entered which is held in the form object.
             subject = form.subject.data,
             content = form.content.data,
-            tag = form.tag.data,
+            tag = normalizeTag(form.tag.data),
             author = current_user.id,
             # This sets the modifydate to the current datetime.
             modify_date = dt.datetime.utcnow
@@ -142,7 +205,7 @@ def blogEdit(blogID):
         editBlog.update(
             subject = form.subject.data,
             content = form.content.data,
-            tag = form.tag.data,
+            tag = normalizeTag(form.tag.data),
             modify_date = dt.datetime.utcnow
         )
         # After updating the document, send the user to the updated blog using a redirect.
@@ -173,15 +236,48 @@ def commentNew(blogID):
     blog = Blog.objects.get(id=blogID)
     form = CommentForm()
     if form.validate_on_submit():
+        # The id is made here so it can be put in the comment's path
+        newID = ObjectId()
+        path, depth = commentPath(newID)
         newComment = Comment(
+            id = newID,
             author = current_user.id,
             blog = blogID,
-            content = form.content.data
+            content = form.content.data,
+            path = path,
+            depth = depth
         )
-        newComment.save()
+        newComment.save(force_insert=True)
         return redirect(url_for('blog',blogID=blogID))
     return render_template('commentform.html',form=form,blog=blog)
 
+# This is a reply to another comment. It is the same as a new comment except it also
+# stores the comment it answers and its place in the discussion (path and depth).
+@app.route('/comment/reply/<commentID>', methods=['GET', 'POST'])
+@login_required
+def commentReply(commentID):
+    parent = Comment.objects.get(id=commentID)
+    blog = Blog.objects.get(id=parent.blog.id)
+    if (parent.depth or 0) >= app.config['COMMENT_MAX_DEPTH']:
+        flash("This discussion is too deep to reply to this comment.")
+        return redirect(url_for('blog',blogID=blog.id))
+    form = CommentForm()
+    if form.validate_on_submit():
+        newID = ObjectId()
+        path, depth = commentPath(newID, parent)
+        newComment = Comment(
+            id = newID,
+            author = current_user.id,
+            blog = blog.id,
+            comment = parent.id,
+            content = form.content.data,
+            path = path,
+            depth = depth
+        )
+        newComment.save(force_insert=True)
+        return redirect(url_for('blog',blogID=blog.id))
+    return render_template('commentform.html',form=form,blog=blog,parent=parent)
+
 @app.route('/comment/edit/<commentID>', methods=['GET', 'POST'])
 @login_required
 def commentEdit(commentID):
@@ -206,6 +302,9 @@ def commentEdit(commentID):
 @login_required
 def commentDelete(commentID): 
     deleteComment = Comment.objects.get(id=commentID)
+    # Delete all the replies under this comment in one query. Their paths start with this one's.
+    if deleteComment.path:
+        Comment.objects(blog=deleteComment.blog.id, path__startswith=deleteComment.path + '/').delete()
     deleteComment.delete()
     flash('The comments was deleted.')
     return redirect(url_for('blog',blogID=deleteComment.blog.id)) 
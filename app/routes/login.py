@@ -1,6 +1,5 @@
 
 # Python standard libraries
-import json
 from app import app, login_manager
 from flask import redirect, request, url_for, flash
 from flask_login import (
@@ -9,17 +8,18 @@ from flask_login import (
     login_user,
     logout_user,
 )
-from oauthlib.oauth2 import WebApplicationClient
-import requests
 from app.classes.data import User
-from app.utils.secrets import getSecrets
+from app.utils.http import httpSession, httpTimeout, RefreshingValue
+from app.utils.usercache import userCache
+from app.utils.settings import setting
 import mongoengine.errors
 
-#get all the credentials for google
-secrets = getSecrets()
-
-# OAuth2 client setup
-client = WebApplicationClient(secrets['GOOGLE_CLIENT_ID'])
+# OAuth2 client setup. The client remembers the token it gets during a login so every
+# login makes its own client. Sharing one would mix up two students logging in at the
+# same time. oauthlib is imported the first time someone logs in, not when the app starts.
+def oauthClient():
+    from oauthlib.oauth2 import WebApplicationClient
+    return WebApplicationClient(setting('GOOGLE_CLIENT_ID'))
 
 # When a route is decorated with @login_required and fails this code is run
 # https://flask-login.readthedocs.io/en/latest/#flask_login.LoginManager.unauthorized_handler
@@ -32,14 +32,28 @@ def unauthorized():
 # https://flask-login.readthedocs.io/en/latest/#flask_login.LoginManager.user_loader
 @login_manager.user_loader
 def load_user(id):
-    try:
-        return User.objects.get(pk=id)
-    except mongoengine.errors.DoesNotExist:
-        flash("Something strange has happened. This user doesn't exist. Please click logout.")
-        return redirect(url_for('index'))
+    # Look in the cache first. See utils/usercache.py
+    record = userCache.get(id)
+    if record is None:
+        try:
+            record = User.objects(pk=id).as_pymongo().get()
+        except mongoengine.errors.DoesNotExist:
+            flash("Something strange has happened. This user doesn't exist. Please click logout.")
+            return redirect(url_for('index'))
+        userCache.put(id, record)
+    return User._from_son(record)
+
+# Google's login settings (the urls to send people to) almost never change so they
+# are remembered instead of asked for on every login. See RefreshingValue in utils/http.py
+def fetch_google_provider_cfg():
+    response = httpSession().get(setting('GOOGLE_DISCOVERY_URL'), timeout=httpTimeout)
+    response.raise_for_status()
+    return response.json()
+
+google_provider_cfg_cache = RefreshingValue(fetch_google_provider_cfg, app.config['OAUTH_DISCOVERY_TTL'])
 
 def get_google_provider_cfg():
-    return requests.get(secrets['GOOGLE_DISCOVERY_URL']).json()
+    return google_provider_cfg_cache.get()
 
 @app.route("/login")
 def login():
@@ -49,7 +63,7 @@ def login():
 
     # Use library to construct the request for login and provide
     # scopes that let you retrieve user's profile from Google
-    request_uri = client.prepare_request_uri(
+    request_uri = oauthClient().prepare_request_uri(
         authorization_endpoint,
         redirect_uri=request.base_url + "/callback",
         scope=["openid", "email", "profile"],
@@ -69,31 +83,34 @@ def callback():
     token_endpoint = google_provider_cfg["token_endpoint"]
 
     # Prepare and send request to get tokens! Yay tokens!
+    client = oauthClient()
     token_url, headers, body = client.prepare_token_request(
         token_endpoint,
         authorization_response=request.url,
         redirect_url=request.base_url,
         code=code,
     )
-    token_response = requests.post(
+    token_response = httpSession().post(
         token_url,
         headers=headers,
         data=body,
-        auth=(secrets['GOOGLE_CLIENT_ID'], secrets['GOOGLE_CLIENT_SECRET']),
+        auth=(setting('GOOGLE_CLIENT_ID'), setting('GOOGLE_CLIENT_SECRET')),
+        timeout=httpTimeout,
     )
 
     # Parse the tokens!
-    client.parse_request_body_response(json.dumps(token_response.json()))
+    client.parse_request_body_response(token_response.text)
 
     # Now that we have tokens (yay) let's find and hit URL
     # from Google that gives you user's profile information,
     # including their Google Profile Image and Email
     userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
     uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests.get(uri, headers=headers, data=body)
+    userinfo_response = httpSession().get(uri, headers=headers, data=body, timeout=httpTimeout)
+    userinfo = userinfo_response.json()
 
     ### Example info that comes back from google
-    # userinfo_response.json() --> {
+    # userinfo --> {
     # 'sub': '118043475517321263044', 
     # 'name': 'STEPHEN WRIGHT', 
     # 'given_name': 'STEPHEN', 
@@ -106,20 +123,20 @@ def callback():
     # 'hd': 'ousd.org'
     # }
 
-    # if userinfo_response.json().get("hd") != "ousd.org":
+    # if userinfo.get("hd") != "ousd.org":
     #     flash("You must have an ousd.org email account to access this site.")
     #     return "You must have an ousd.org email account to access this site.", 400
 
     # We want to make sure their email is verified.
     # The user authenticated with Google, authorized our
     # app, and now we've verified their email through Google!
-    if userinfo_response.json().get("email_verified"):
-        gid = userinfo_response.json()["sub"]
-        gmail = userinfo_response.json()["email"]
-        gprofile_pic = userinfo_response.json()["picture"]
-        gname = userinfo_response.json()["name"]
-        gfname = userinfo_response.json()["given_name"]
-        glname = userinfo_response.json()["family_name"]
+    if userinfo.get("email_verified"):
+        gid = userinfo["sub"]
+        gmail = userinfo["email"]
+        gprofile_pic = userinfo["picture"]
+        gname = userinfo["name"]
+        gfname = userinfo["given_name"]
+        glname = userinfo["family_name"]
     else:
         return "User email not available or not verified by Google.", 400
 
@@ -128,7 +145,7 @@ def callback():
         thisUser=User.objects.get(email=gmail)
     # if the user does not exist, create them and make sure they are ousd.org
     except mongoengine.errors.DoesNotExist:
-        # if userinfo_response.json().get("hd") == "ousd.org":
+        # if userinfo.get("hd") == "ousd.org":
         thisUser = User(
             gid=gid, 
             gname=gname, 
@@ -143,12 +160,16 @@ def callback():
         #     flash("You must have an ousd.org email to login to this site.")
         #     return redirect(url_for('index'))
     else:
+        # The name is only sent when it changed because a new name means the lists
+        # that show names have to be rendered again. See utils/fragcache.py
+        names = {}
+        if (thisUser.fname, thisUser.lname) != (gfname, glname):
+            names = dict(fname = gfname, lname = glname)
         thisUser.update(
             gid=gid, 
             gname=gname, 
             gprofile_pic=gprofile_pic,
-            fname = gfname,
-            lname = glname
+            **names
         )
     thisUser.reload()
 
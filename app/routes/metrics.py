@@ -0,0 +1,19 @@
+# Prometheus reads this page every few seconds. See utils/metrics.py for what is on it.
+# If METRICS_TOKEN is set the request has to send it, either as the header
+# "Authorization: Bearer <token>" or as ?token=<token>.
+
+import hmac
+from app import app
+from flask import request, abort, Response
+from app.utils.metrics import registry
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if token:
+        # (not str.removeprefix, that needs Python 3.9 and requirements3-6.txt is older)
+        header = request.headers.get('Authorization', '')
+        sent = (header[len('Bearer '):] if header.startswith('Bearer ') else '').strip() or request.args.get('token', '')
+        if not hmac.compare_digest(sent.encode('utf-8'), token.encode('utf-8')):
+            abort(403)
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,22 @@
+# The profiles saved by utils/profiler.py. Only admins (ADMIN_EMAILS) can see them.
+# Each one is a .collapsed text file. To see it as a flame graph open it on
+# https://www.speedscope.app or run: flamegraph.pl profile.collapsed > profile.svg
+
+from app import app
+from flask import render_template, abort, send_from_directory
+from app.utils.admin import adminRequired
+from app.utils.profiler import listProfiles, profileDir, PROFILE_NAME
+
+@app.route('/admin/profiles')
+@adminRequired
+def profileList():
+    return render_template('profiles.html',profiles=listProfiles(),
+        sampleRate=app.config['PROFILE_SAMPLE_RATE'],keep=app.config['PROFILE_KEEP'])
+
+@app.route('/admin/profiles/<name>')
+@adminRequired
+def profileDownload(name):
+    # Only names the profiler makes, so nobody can ask for ../../something
+    if not PROFILE_NAME.match(name):
+        abort(404)
+    return send_from_directory(profileDir(), name, as_attachment=True, mimetype='text/plain')
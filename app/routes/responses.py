@@ -1,135 +1,194 @@
 from app import app
 import mongoengine.errors
-from flask import render_template, flash, redirect, url_for
+from flask import render_template, flash, redirect, url_for, abort, request
 from flask_login import current_user
-from app.classes.data import Response, Comment
-from app.classes.forms import ResponseForm, CommentForm
+from app.classes.data import Response, Comment, User, PuzzleSession, PuzzleStats, Attempt
+from app.classes.forms import CommentForm, puzzleForm
+from app.classes.puzzles import puzzleBank
 from flask_login import login_required
+from app.utils.pagination import paginate
+from app.utils.loaders import attachReferences
+from app.utils.fragcache import fragmentCache
 import datetime as dt
-from random import sample
-
-questions = [{"q":"1+1?","a":["2","two"]},
-             {"q":"1+2?","a":["3","three"]},
-             {"q":"1+3?","a":["4","four"]},
-             {"q":"What has a lot of water and starts with an O?","a":["Ocean","ocean","OCEAN"]},
-             {"q":"Rearrange these letters to create a word: L F O R E W","a":["FLOWER","flower","Flower"]},
-             {"q":"What do you use to communicate and is a 5 letter word?","a":["Phone","phone","PHONE"]},
-             {"q":"Which season is cold?","a":["Winter","winter","WINTER"]},
-             {"q":"Which vehicle can fly?","a":["Airplane","airplane","AIRPLANE","Plane","plane","PLANE"]},
-             {"q":"Which planet do we live in?","a":["Earth","earth","EARTH"]},]
-
-
-@app.route('/response/new', methods=['GET', 'POST'])
+import random
+
+# This adds answers to the user's open PuzzleSession, or starts a new one if they
+# don't have one, and adds their points to its score. It is one request to MongoDB:
+# modify() finds, updates and returns the session all at once.
+def recordAttempts(user, puzzleset, questions, answers):
+    attempts = [Attempt(
+            puzzleset = puzzleset,
+            question = question.id,
+            q = question.q,
+            answer = answer,
+            correct = question.check(answer)
+        ) for question, answer in zip(questions, answers)]
+    correct = sum(1 for attempt in attempts if attempt.correct)
+    now = dt.datetime.utcnow()
+    try:
+        session = PuzzleSession.objects(author=user.id, open=True).modify(
+            upsert = True,
+            new = True,
+            push_all__attempts = attempts,
+            inc__score = correct,
+            set__modify_date = now,
+            set_on_insert__create_date = now
+        )
+    except mongoengine.errors.NotUniqueError:
+        # Two pages started a session at the same moment and the other one won.
+        # Now there is an open session so this will add to it.
+        return recordAttempts(user, puzzleset, questions, answers)
+
+    # Add to the user's running totals for the leaderboard
+    PuzzleStats.objects(user=user.id).update_one(
+        upsert = True,
+        inc__sessions = 1 if len(session.attempts) == len(attempts) else 0,
+        inc__attempts = len(attempts),
+        inc__correct = correct,
+        max__best_score = session.score
+    )
+    return session
+
+# This takes a deleted session back out of its author's running totals
+def forgetSession(session):
+    authorID = session.author.id
+    PuzzleStats.objects(user=authorID).update_one(
+        dec__sessions = 1,
+        dec__attempts = len(session.attempts),
+        dec__correct = session.score
+    )
+    # If it was their best session find their new best one. This only looks at
+    # this student's sessions and uses the (author, -score) index.
+    stats = PuzzleStats.objects(user=authorID).only('best_score').first()
+    if stats and session.score >= stats.best_score:
+        best = PuzzleSession.objects(author=authorID).order_by('-score').only('score').first()
+        stats.update(set__best_score = best.score if best else 0)
+
+# This route shows any puzzle set from puzzles.json. setID is the "id" of the set.
+@app.route('/puzzle/<setID>', methods=['GET', 'POST'])
 # This means the user must be logged in to see this page
 @login_required
 # This is a function that is run when the user requests this route.
-def responseNew():
-    # This gets the form object from the form.py classes that can be displayed on the template.
-    form = ResponseForm()
-
-    #chosenQuestions = sample(questions,k=3)
+def puzzle(setID):
+    # Look up the puzzle set. If there isn't one with this id show a 'not found' page
+    puzzleSet = puzzleBank.sets.get(setID)
+    if puzzleSet is None:
+        abort(404)
 
-    form.a1.label = questions[0]["q"]
-    form.a2.label = questions[1]["q"]
-    form.a3.label = questions[2]["q"]
+    # This makes a form with one answer field for each question in the set.
+    form = puzzleForm(puzzleSet.questions)
 
     # This is a conditional that evaluates to 'True' if the user submitted the form successfully.
     # validate_on_submit() is a method of the form object. 
     if form.validate_on_submit():
+        answers = [form[f'a{i}'].data for i in range(len(puzzleSet.questions))]
 
-        # This stores all the values that the user entered into the new blog form. 
-        # Blog() is a mongoengine method for creating a new blog. 'newBlog' is the variable 
-        # that stores the object that is the result of the Blog() method.  
-        newResponse = Response(
-            # the left side is the name of the field from the data table
-            # the right side is the data the user entered which is held in the form object.
-
-            q1 = form.a1.label,
-            q2 = form.a2.label,
-            q3 = form.a3.label,
-            a1 = form.a1.data,
-            a2 = form.a2.data,
-            a3 = form.a3.data,
-            score = (1 if form.a1.data in questions[0]["a"] else 0)
-            + (1 if form.a2.data in questions[1]["a"] else 0)
-            + (1 if form.a3.data in questions[2]["a"] else 0),    
-            author = current_user.id,
-
-        )
-        # This is a method that saves the data to the mongoDB database.
-        newResponse.save()
+        # This adds the questions, the user's answers and their points to the user's
+        # puzzle session. Each question knows its right answers so it can check them.
+        session = recordAttempts(current_user, puzzleSet.id, puzzleSet.questions, answers)
 
-        # Once the new blog is saved, this sends the user to that blog using redirect.
-        # and url_for. Redirect is used to redirect a user to different route so that 
-        # routes code can be run. In this case the user just created a blog so we want 
-        # to send them to that blog. url_for takes as its argument the function name
-        # for that route (the part after the def key word). You also need to send any
-        # other values that are needed by the route you are redirecting to.
-        return redirect(url_for('response',responseID=newResponse.id))
+        # Once the answers are saved, this sends the user to see their score.
+        return redirect(url_for('puzzleSession',sessionID=session.id))
 
     # if form.validate_on_submit() is false then the user either has not yet filled out
-    # the form or the form had an error and the user is sent to a blank form. Form errors are 
-    # stored in the form object and are displayed on the form. take a look at blogform.html to 
-    # see how that works.
-    return render_template('responseform.html',form=form)
-
-
-
-@app.route('/response/new2', methods=['GET', 'POST'])
+    # the form or the form had an error and the user is sent to a blank form.
+    return render_template('puzzleform.html',form=form,title=puzzleSet.title)
+
+# This route gives the user random questions from the whole bank. Each user works
+# through their own shuffle of the bank, so they never get a question again until
+# they have seen all of them. Only the shuffle's seed and how far they are into it are
+# saved on the User. See shuffledIndex() and nextQuestions() in classes/puzzles.py
+@app.route('/puzzle/random', methods=['GET', 'POST'])
 @login_required
-def responseNew2():
-    form = ResponseForm()
+def puzzleRandom():
+    size = len(puzzleBank.order)
+    # current_user can come from the user cache, which may be a minute old (or older in
+    # another gunicorn worker), so where the user is in their shuffle is read fresh
+    state = User.objects(id=current_user.id).only('puzzle_seed','puzzle_position','puzzle_bank_size').first()
+    seed = state.puzzle_seed
+    position = state.puzzle_position or 0
+
+    # Start a new shuffle the first time or when the questions in the bank changed
+    if seed is None or state.puzzle_bank_size != size:
+        seed = random.getrandbits(31)
+        position = 0
+        User.objects(id=current_user.id).update_one(
+            set__puzzle_seed = seed,
+            set__puzzle_position = position,
+            set__puzzle_bank_size = size
+        )
 
-    form.a4.label = questions[3]["q"]
-    form.a5.label = questions[4]["q"]
-    form.a6.label = questions[5]["q"]
+    questions, nextSeed, nextPosition = puzzleBank.nextQuestions(seed, position, app.config['PUZZLE_RANDOM_COUNT'])
+    # the hidden field says which page of the shuffle was answered
+    page = f"{seed}:{position}"
+    form = puzzleForm(questions, position=page)
 
     if form.validate_on_submit():
-        newResponse2 = Response(
-            q4 = form.a4.label,
-            q5 = form.a5.label,
-            q6 = form.a6.label,
-            a4 = form.a4.data,
-            a5 = form.a5.data,
-            a6 = form.a6.data,
-            score = (1 if form.a4.data in questions[3]["a"] else 0)
-            + (1 if form.a5.data in questions[4]["a"] else 0)
-            + (1 if form.a6.data in questions[5]["a"] else 0),    
-            author = current_user.id,
-
-        )
-        newResponse2.save()
-        return redirect(url_for('response2',responseID=newResponse2.id))
-    return render_template('responseform2.html',form=form)
-
+        # Move the user on in their shuffle. The update only matches if they are still
+        # on this page, so answers from another tab or an old page are never saved.
+        moved = form.position.data == page and User.objects(id=current_user.id, puzzle_seed=seed,
+            puzzle_position=position).update_one(set__puzzle_seed=nextSeed, set__puzzle_position=nextPosition)
+        if not moved:
+            flash("Those puzzles were already answered. Here are some new ones.")
+            return redirect(url_for('puzzleRandom'))
+
+        answers = [form[f'a{i}'].data for i in range(len(questions))]
+        session = recordAttempts(current_user, 'random', questions, answers)
+        return redirect(url_for('puzzleSession',sessionID=session.id))
+
+    return render_template('puzzleform.html',form=form,title="Random Puzzle")
+
+# This shows all the answers in one puzzle session and the score
+@app.route('/puzzle/session/<sessionID>')
+@login_required
+def puzzleSession(sessionID):
+    thisSession = PuzzleSession.objects.get(id=sessionID)
+    return render_template('puzzlesession.html',session=thisSession)
 
+# Finishing a session means the next puzzle the user answers starts a new one
+@app.route('/puzzle/session/finish/<sessionID>')
+@login_required
+def puzzleSessionFinish(sessionID):
+    PuzzleSession.objects(id=sessionID, author=current_user.id).update_one(set__open=False)
+    return redirect(url_for('puzzleSession',sessionID=sessionID))
 
-@app.route('/response/new3', methods=['GET', 'POST'])
+@app.route('/puzzle/session/delete/<sessionID>')
 @login_required
-def responseNew3():
-    form = ResponseForm()
+def puzzleSessionDelete(sessionID):
+    deleteSession = PuzzleSession.objects.get(id=sessionID)
+    if current_user == deleteSession.author:
+        deleteSession.delete()
+        forgetSession(deleteSession)
+        flash('The puzzle session was deleted.')
+    else:
+        flash("You can't delete a puzzle session you don't own.")
+    return redirect(url_for('responseList'))
 
-    form.a7.label = questions[6]["q"]
-    form.a8.label = questions[7]["q"]
-    form.a9.label = questions[8]["q"]
+# The students with the most correct answers. This reads the running totals in
+# PuzzleStats so it is just as fast with ten million answers as with ten.
+@app.route('/puzzles/leaderboard')
+@login_required
+def puzzleLeaderboard():
+    size = min(request.args.get('n', app.config['LEADERBOARD_SIZE'], type=int), 100)
+    leaders = list(PuzzleStats.objects().order_by('-correct', '-best_score').limit(size))
+    attachReferences(leaders, 'user', User, only=['fname','lname'])
+    return render_template('leaderboard.html',leaders=leaders)
+
+# These are the old addresses of the three puzzles. They are still in the navbar.
+@app.route('/response/new')
+@login_required
+def responseNew():
+    return redirect(url_for('puzzle',setID='1'))
 
-    if form.validate_on_submit():
-        newResponse3 = Response(
-            q7 = form.a7.label,
-            q8 = form.a8.label,
-            q9 = form.a9.label,
-            a7 = form.a7.data,
-            a8 = form.a8.data,
-            a9 = form.a9.data,
-            score = (1 if form.a7.data in questions[6]["a"] else 0)
-            + (1 if form.a8.data in questions[7]["a"] else 0)
-            + (1 if form.a9.data in questions[8]["a"] else 0),    
-            author = current_user.id,
+@app.route('/response/new2')
+@login_required
+def responseNew2():
+    return redirect(url_for('puzzle',setID='2'))
 
-        )
-        newResponse3.save()
-        return redirect(url_for('response3',responseID=newResponse3.id))
-    return render_template('responseform3.html',form=form)
+@app.route('/response/new3')
+@login_required
+def responseNew3():
+    return redirect(url_for('puzzle',setID='3'))
 
 
 
@@ -189,13 +248,15 @@ def response3(responseID):
 # This means the user must be logged in to see this page
 @login_required
 def responseList():
-    # This retrieves all of the 'blogs' that are stored in MongoDB and places them in a
-    # mongoengine object as a list of dictionaries name 'blogs'.
-    responses = Response.objects()
-    # This renders (shows to the user) the blogs.html template. it also sends the blogs object 
-    # to the template as a variable named blogs.  The template uses a for loop to display
-    # each blog.
-    return render_template('responses.html',responses=responses)
+    # This retrieves one page of the puzzle sessions that are stored in MongoDB. It only
+    # runs when the page isn't in the fragment cache. See utils/fragcache.py
+    def load():
+        page = paginate(PuzzleSession.objects())
+        return dict(sessions=page.items,page=page)
+    rows = fragmentCache.render('puzzles', 'includes/_responsesrows.html', load)
+    # This renders (shows to the user) the responses.html template with the rows of
+    # sessions in it. The template uses a for loop to display each session.
+    return render_template('responses.html',rows=rows,puzzleSets=puzzleBank.sets.values())
 
 
 @app.route('/response/delete/<responseID>')
@@ -214,10 +275,8 @@ def responseDelete(responseID):
     else:
         # if the user is not the author tell them they were denied.
         flash("You can't delete a blog you don't own.")
-    # Retrieve all of the remaining blogs so that they can be listed.
-    responses = Response.objects()  
-    # Send the user to the list of remaining blogs.
-    return render_template('responses.html',responses=responses)
+    # Send the user to the list of remaining responses.
+    return redirect(url_for('responseList'))
 
 
 
@@ -1,11 +1,16 @@
-from matplotlib import pyplot as plt
 from app import app
 import mongoengine.errors
-from flask import render_template, flash, redirect, url_for
+from flask import render_template, flash, redirect, url_for, request, make_response, jsonify
 from flask_login import current_user
 from app.classes.data import Sleep, User
 from app.classes.forms import SleepForm, ConsentForm
 from flask_login import login_required
+from app.utils.graphs import sleepDigest, sleepGraph
+from app.utils.series import lttb
+from app.utils.sleepstats import sleepStats
+from app.utils.pagination import paginate
+from app.utils.fragcache import fragmentCache
+from app.utils.loaders import attachReferences
 import datetime as dt
 
 @app.route('/consent', methods=['GET', 'POST'])
@@ -42,7 +47,7 @@ def sleepNew():
     if form.validate_on_submit():
         startDT = dt.datetime.combine(form.sleep_date.data, form.starttime.data)
         endDT = dt.datetime.combine(form.wake_date.data, form.endtime.data)
-        diff = startDT - endDT
+        diff = endDT - startDT
         hours = diff.seconds/60/60
         newSleep = Sleep(
             hours = hours,
@@ -50,6 +55,7 @@ def sleepNew():
             rating = form.rating.data,
             start = startDT,
             end = endDT,
+            sleep_date = dt.datetime.combine(form.sleep_date.data, dt.time()),
             feel = form.feel.data,
             minstosleep = form.minstosleep.data,
         )
@@ -86,6 +92,7 @@ def sleepEdit(sleepId):
             rating = form.rating.data,
             start = startDT,
             end = endDT,
+            sleep_date = dt.datetime.combine(form.sleep_date.data, dt.time()),
             feel = form.feel.data,
             minstosleep = form.minstosleep.data
         )
@@ -111,8 +118,13 @@ def sleep(sleepId):
 @login_required
 
 def sleeps():
-    sleeps = Sleep.objects()
-    return render_template("sleeps.html",sleeps=sleeps)
+    # only run when this page isn't in the fragment cache. See utils/fragcache.py
+    def load():
+        page = paginate(Sleep.objects())
+        attachReferences(page.items, 'sleeper', User, only=['fname','lname'])
+        return dict(sleeps=page.items,page=page)
+    rows = fragmentCache.render('sleeps', 'includes/_sleepsrows.html', load)
+    return render_template("sleeps.html",rows=rows)
 
 @app.route('/sleep/delete/<sleepId>')
 @login_required
@@ -128,33 +140,85 @@ def sleepDelete(sleepId):
 @login_required
 
 def sleepgraph():
-    sleeps = Sleep.objects()
-
-
-    hours = []
-    dates = []
-    colors = []
-    for sleep in sleeps:
-        hours.append(sleep.hours)
-        dates.append(sleep.start.date())   
-        if sleep.rating >=4:
-            colors.append('green')
-        elif sleep.rating == 3:
-            colors.append('yellow')
-        else:
-            colors.append('red')
-    
-    plt.switch_backend('Agg') 
-    fig, ax = plt.subplots()
-    
-    ax.scatter(dates, hours, marker='o', c=colors)
+    return render_template('sleepgraph.html')
 
+# This sends the current user's graph as a png straight from memory. The graph is
+# only drawn when this user's sleeps have changed since it was last drawn.
+@app.route('/sleepgraph.png')
+@login_required
+
+def sleepgraphImage():
+    sleeps = Sleep.objects(sleeper=current_user.id).only('start','hours','rating').order_by('start')
+    rows = [(sleep.start, sleep.hours, sleep.rating) for sleep in sleeps if sleep.start]
+
+    digest = sleepDigest(rows)
+    if digest in request.if_none_match:
+        resp = make_response('', 304)
+    else:
+        resp = make_response(sleepGraph(digest, rows))
+        resp.mimetype = 'image/png'
+    resp.set_etag(digest)
+    # private because the graph belongs to one user, no-cache so the browser asks
+    # again (and gets a 304) every time instead of showing an old graph
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+# Weekly and monthly averages of the current user's sleeps, how much their bedtime
+# moves around and their sleep debt. ?target=8.5 changes how many hours a night the
+# debt is counted against. See utils/sleepstats.py
+@app.route('/sleep/stats')
+@login_required
 
-    ax.legend()
-    plt.yticks(hours)
-    plt.xticks(dates, rotation=45)
-    plt.gcf().set_size_inches(10, 5)
-    fig.savefig("app/static/graphs/sleep.png", bbox_inches="tight")
-    fig.show()
-    return render_template('sleepgraph.html',images=['sleep.png'])
+def sleepStatsPage():
+    target = request.args.get('target', app.config['SLEEP_TARGET_HOURS'], type=float)
+    stats = sleepStats(current_user.id, target, app.config['SLEEP_STATS_WEEKS'], app.config['SLEEP_STATS_MONTHS'])
+    return render_template('sleepstats.html',stats=stats,target=target)
+
+# This sends the current user's sleeps as plain numbers so the browser can draw the
+# graph itself. ?start=2024-01-01&end=2024-02-01 limits the dates (end is not included),
+# ?points=300 shrinks a long history down to about that many sleeps and ?format=rows
+# sends one list per sleep instead of one list per field.
+# "2024-01-31" or "2024-01-31T22:30". (datetime.fromisoformat would do this but it
+# needs Python 3.7 and requirements3-6.txt is older.)
+def parseDate(text):
+    for format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return dt.datetime.strptime(text, format)
+        except ValueError:
+            pass
+    raise ValueError(f"{text!r} isn't a date")
+
+@app.route('/sleep/series')
+@login_required
 
+def sleepSeries():
+    fields = ['start','hours','rating','feel','minstosleep']
+    query = {'sleeper': current_user.id}
+    try:
+        if request.args.get('start'):
+            query['start__gte'] = parseDate(request.args['start'])
+        if request.args.get('end'):
+            query['start__lt'] = parseDate(request.args['end'])
+        points = int(request.args.get('points', 0))
+    except ValueError:
+        return jsonify(error="start and end must be dates like 2024-01-31 and points must be a number"), 400
+
+    # as_pymongo() skips building a Sleep object for every row
+    sleeps = Sleep.objects(**query).only(*fields).order_by('start').as_pymongo()
+    sleeps = [sleep for sleep in sleeps if sleep.get('start') and sleep.get('hours') is not None]
+
+    # dates are sent as milliseconds since 1970 which is what javascript Dates use
+    epoch = dt.datetime(1970, 1, 1)
+    starts = [(sleep['start'] - epoch) // dt.timedelta(milliseconds=1) for sleep in sleeps]
+    if points:
+        keep = lttb(starts, [sleep['hours'] for sleep in sleeps], points)
+        sleeps = [sleeps[i] for i in keep]
+        starts = [starts[i] for i in keep]
+
+    columns = {'start': starts}
+    for field in fields[1:]:
+        columns[field] = [sleep.get(field) for sleep in sleeps]
+
+    if request.args.get('format') == 'rows':
+        return jsonify(fields=fields, rows=list(zip(*[columns[field] for field in fields])))
+    return jsonify(columns)
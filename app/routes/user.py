@@ -1,9 +1,11 @@
 from app import app
 from flask_login.utils import login_required
-from flask import render_template, redirect, flash, url_for
+from flask import render_template, redirect, flash, url_for, request, abort, Response
 from app.classes.data import User
 from app.classes.forms import ProfileForm
 from flask_login import current_user
+from app.utils.images import imageSizes, makeThumbnail, streamFile
+import mongoengine.errors
 
 # These routes and functions are for accessing and editing user profiles.
 
@@ -38,9 +40,22 @@ def profileEdit():
         )
         # This updates the profile image
         if form.image.data:
+            # Pillow is only loaded when someone uploads a picture. See utils/images.py
+            from PIL import UnidentifiedImageError
+            data = form.image.data.read()
             if currUser.image:
                 currUser.image.delete()
-            currUser.image.put(form.image.data, content_type = 'image/jpeg')
+            currUser.image.put(data, content_type = form.image.data.mimetype or 'image/jpeg')
+            # This makes the smaller copies of the image. See utils/images.py
+            for size, width in imageSizes.items():
+                thumbnail = getattr(currUser, 'image_' + size)
+                if thumbnail:
+                    thumbnail.delete()
+                try:
+                    thumbnail.put(makeThumbnail(data, width), content_type = 'image/jpeg')
+                except (UnidentifiedImageError, OSError) as error:
+                    # not a picture Pillow can read, the full image is sent instead
+                    app.logger.warning(f"Unable to make the {size} picture for user {currUser.id}: {error}")
             # This saves all the updates
             currUser.save()
         # Then sends the user to their profle page
@@ -54,3 +69,35 @@ def profileEdit():
     form.age.data = current_user.age
     
     return render_template('profileform.html', form=form)
+
+# This sends a user's profile image. Templates use it like this:
+#     <img src="{{url_for('userImage', userID=user.id, size='small')}}">
+# The image is sent a piece at a time straight from the database. The ETag and
+# Last-Modified headers let the browser keep a copy and only ask "has it changed?"
+# The url stays the same when a new picture is uploaded, so the browser has to ask
+# every time (no-cache). The answer is a tiny 304 unless the picture changed.
+@app.route('/user/<userID>/image')
+@login_required
+def userImage(userID):
+    try:
+        user = User.objects(id=userID).only('image', *['image_' + size for size in imageSizes]).get()
+    except (mongoengine.errors.DoesNotExist, mongoengine.errors.ValidationError):
+        abort(404)
+
+    image = user.image
+    size = request.args.get('size')
+    if size in imageSizes and getattr(user, 'image_' + size):
+        image = getattr(user, 'image_' + size)
+    gridout = image.get()
+    if gridout is None:
+        abort(404)
+
+    resp = Response(streamFile(gridout), mimetype=gridout.content_type or 'image/jpeg')
+    resp.content_length = gridout.length
+    # every upload is a new file with a new id so the id is a good ETag
+    resp.set_etag(str(gridout._id))
+    resp.last_modified = gridout.upload_date
+    # private because you have to be logged in to see it, no-cache so a new picture
+    # shows up right away instead of the old one staying for a day
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp.make_conditional(request)
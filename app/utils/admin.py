@@ -0,0 +1,24 @@
+# Admins are the users whose email is in ADMIN_EMAILS (comma separated, set in the
+# environment or secrets.py). The role on the profile form can't be used for this
+# because users can change it themselves.
+
+from functools import wraps
+from flask import abort
+from flask_login import current_user, login_required
+from app import app
+
+def adminEmails():
+    return {email.strip().lower() for email in app.config['ADMIN_EMAILS'].split(',') if email.strip()}
+
+def isAdmin(user):
+    return bool(user and user.is_authenticated and user.email and user.email.lower() in adminEmails())
+
+# Like @login_required but the user also has to be an admin
+def adminRequired(route):
+    @wraps(route)
+    @login_required
+    def check(*args, **kwargs):
+        if not isAdmin(current_user):
+            abort(403)
+        return route(*args, **kwargs)
+    return check
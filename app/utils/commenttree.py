@@ -0,0 +1,37 @@
+# Comments can be replies to other comments. Every comment stores its "path": the ids
+# of the comments above it and then its own id, like "id1/id2/id3". Sorting a blog's
+# comments by path puts every reply right after the comment it answers, so the whole
+# discussion comes back in order from ONE query and buildCommentTree() just has to
+# hang each comment under the one before it in its path.
+
+class CommentNode:
+    def __init__(self, comment):
+        self.comment = comment
+        self.children = []
+
+# The path and depth for a new comment. parent is None for a comment on the blog itself.
+def commentPath(commentID, parent=None):
+    if parent is None:
+        return str(commentID), 0
+    return f"{parent.path or parent.id}/{commentID}", (parent.depth or 0) + 1
+
+def parentID(comment):
+    if comment.path and '/' in comment.path:
+        return comment.path.split('/')[-2]
+    return None
+
+# comments must be sorted by path. Returns the comments that aren't replies, each with
+# its replies in .children. If a page starts in the middle of a discussion, the replies
+# whose parent is on the page before are shown at the top.
+def buildCommentTree(comments):
+    nodes = {}
+    roots = []
+    for comment in comments:
+        node = CommentNode(comment)
+        nodes[str(comment.id)] = node
+        parent = nodes.get(parentID(comment))
+        if parent:
+            parent.children.append(node)
+        else:
+            roots.append(node)
+    return roots
@@ -0,0 +1,45 @@
+# Connecting to MongoDB. connect=False means the MongoClient doesn't open any
+# connections (or start its monitoring threads) until the first query. That matters
+# for the production server (see gunicorn.conf.py in the top folder): the app is
+# loaded once and then copied into each worker process with fork(), and a MongoClient
+# must never be shared between processes. Each worker calls reconnectDB() right after
+# it is forked so it gets its own client and its own pool of connections.
+#
+# Every worker has its own pool so the most connections MongoDB will see is
+# workers * MONGO_MAX_POOL_SIZE. A worker never needs more than one connection per
+# thread at a time.
+
+from mongoengine import connect, disconnect
+from app import app
+
+def connectDB():
+    if app.config['MONGO_IN_MEMORY']:
+        return connectMemory()
+    # certifi is only needed here so it isn't imported with the rest of the app
+    import certifi
+    return connect(app.config['MONGO_DB_NAME'],
+        host = app.config['MONGO_HOST'],
+        tlsCAFile = certifi.where(),
+        connect = False,
+        maxPoolSize = app.config['MONGO_MAX_POOL_SIZE'],
+        minPoolSize = app.config['MONGO_MIN_POOL_SIZE'],
+        connectTimeoutMS = app.config['MONGO_CONNECT_TIMEOUT_MS'],
+        serverSelectionTimeoutMS = app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+        socketTimeoutMS = app.config['MONGO_SOCKET_TIMEOUT_MS'] or None,
+        waitQueueTimeoutMS = app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS'] or None,
+        readPreference = app.config['MONGO_READ_PREFERENCE'])
+
+# MONGO_IN_MEMORY: mongoengine makes a mongomock client for a mongomock:// host. FileFields
+# (the profile pictures) use GridFS, which mongomock only has once it is switched on.
+# The database lives in this process, so with the production server every worker
+# would have its own. It is for tests and benchmarks, not for gunicorn.
+def connectMemory():
+    import mongomock.gridfs
+    mongomock.gridfs.enable_gridfs_integration()
+    return connect(app.config['MONGO_DB_NAME'], host=app.config['MONGO_HOST'])
+
+# Throws away this process's client (and the collections mongoengine remembered
+# from it) and makes a new one that connects when it is first used.
+def reconnectDB():
+    disconnect()
+    return connectDB()
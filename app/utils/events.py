@@ -0,0 +1,262 @@
+# Caches, counters and search all need to know when a Blog, Comment, Sleep, Clinic,
+# Response or User changes. Instead of remembering to call them from every route,
+# every write to MongoDB is announced here and they subscribe to the changes.
+#
+# mongoengine's own signals miss a lot: queryset .update() and .modify() don't send
+# them and neither do the CASCADE deletes (deleting a User deletes their Blogs). So the
+# Documents in data.py use EventDocument and EventQuerySet below, which announce a
+# Change after EVERY save, update, modify, insert and delete, cascades included.
+#
+# There are two kinds of subscribers:
+#   sync=True  - called right away, before the route goes on. For caches that must
+#                never show old data, like the user cache.
+#   sync=False - called later on a background thread with a list of changes, so a
+#                slow subscriber never slows a page down. Changes are sent in batches
+#                of up to EVENT_BATCH_SIZE, waiting up to EVENT_BATCH_WAIT seconds.
+#
+# fields=[...] means only updates that change one of those fields are sent. With
+# snapshot=True each change also carries those fields of the documents from before
+# and after the change (this costs a read, so only ask when you need it).
+#
+#   @events.subscribe('Blog', fields=['tag'], snapshot=True)
+#   def countTags(changes):
+#       ...
+
+import atexit
+import queue
+import threading
+from collections import defaultdict
+from flask_mongoengine import Document, BaseQuerySet
+from app import app
+
+class Change:
+    def __init__(self, document, kind, ids=None, fields=None, before=None, after=None):
+        # the name of the Document class, like 'Blog'
+        self.document = document
+        # 'insert', 'update' or 'delete'
+        self.kind = kind
+        # the _ids that changed, or None if that isn't known (like an update by a query
+        # that isn't on _id). Subscribers should treat None as "maybe any of them".
+        self.ids = ids
+        # the names of the fields that changed, or None for all of them
+        self.fields = fields
+        # the raw documents before and after the change, with only the fields that
+        # subscribers asked for. Only filled in when a subscriber asked for a snapshot.
+        self.before = before or []
+        self.after = after or []
+
+    def touches(self, fields):
+        return self.fields is None or bool(self.fields & set(fields))
+
+    def __repr__(self):
+        return f"<Change {self.kind} {self.document} ids={self.ids} fields={self.fields}>"
+
+class Subscriber:
+    def __init__(self, handler, kinds, fields, snapshot, sync):
+        self.handler = handler
+        self.kinds = kinds
+        self.fields = fields
+        self.snapshot = snapshot
+        self.sync = sync
+
+    def wants(self, change):
+        if change.kind not in self.kinds:
+            return False
+        return change.kind != 'update' or not self.fields or change.touches(self.fields)
+
+class EventBus:
+    def __init__(self):
+        self.subscribers = defaultdict(list)
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def subscribe(self, document, kinds=('insert', 'update', 'delete'), fields=(), snapshot=False, sync=False):
+        def register(handler):
+            self.subscribers[document].append(Subscriber(handler, set(kinds), list(fields), snapshot, sync))
+            return handler
+        return register
+
+    # The fields subscribers want to see before and after a change. If nobody wants
+    # any, a write costs no extra reads.
+    def wantedFields(self, document, kind, touched=None):
+        wanted = set()
+        for subscriber in self.subscribers.get(document, []):
+            if subscriber.snapshot and kind in subscriber.kinds and (touched is None or touched & set(subscriber.fields)):
+                wanted.update(subscriber.fields)
+        return wanted
+
+    def publish(self, change):
+        queued = False
+        for subscriber in self.subscribers.get(change.document, []):
+            if not subscriber.wants(change):
+                continue
+            if subscriber.sync:
+                self.deliver(subscriber, [change])
+            elif not queued:
+                self.queue.put(change)
+                queued = True
+        if queued:
+            self.start()
+
+    def deliver(self, subscriber, changes):
+        try:
+            subscriber.handler(changes)
+        except Exception:
+            # one broken subscriber must not stop the write or the other subscribers
+            app.logger.exception(f"Event subscriber {subscriber.handler.__name__} failed")
+
+    def start(self):
+        with self.lock:
+            # the thread is started the first time it is needed
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            self.collect(batch, timeout=app.config['EVENT_BATCH_WAIT'])
+            self.dispatch(batch)
+
+    # Wait a little for more changes so subscribers get them together
+    def collect(self, batch, timeout):
+        while len(batch) < app.config['EVENT_BATCH_SIZE']:
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+    def dispatch(self, batch):
+        try:
+            byDocument = defaultdict(list)
+            for change in batch:
+                byDocument[change.document].append(change)
+            for document, changes in byDocument.items():
+                for subscriber in self.subscribers.get(document, []):
+                    if subscriber.sync:
+                        continue
+                    mine = [change for change in changes if subscriber.wants(change)]
+                    if mine:
+                        self.deliver(subscriber, mine)
+        finally:
+            for change in batch:
+                self.queue.task_done()
+
+    # Deliver everything that is waiting. Used at exit and by scripts that need the
+    # subscribers to have finished, like the CLI commands.
+    def flush(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.dispatch(batch)
+        self.queue.join()
+
+events = EventBus()
+atexit.register(events.flush)
+
+# The _id the query is for, if it is for one _id or a list of them
+def idsFromQuery(query):
+    value = query.get('_id')
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        return list(value['$in']) if list(value) == ['$in'] else None
+    return [value]
+
+# The field names in mongoengine update arguments like set__tag or inc__count
+def updatedFields(document, update):
+    fields = set()
+    for key in update:
+        for part in key.split('__'):
+            if part in document._fields:
+                fields.add(part)
+                break
+    return fields
+
+def snapshot(queryset, ids, fields):
+    if not fields:
+        return []
+    if ids is not None:
+        queryset = queryset.clone().filter(id__in=ids)
+    return list(queryset.clone().only(*fields).as_pymongo())
+
+class EventQuerySet(BaseQuerySet):
+    def update(self, upsert=False, multi=True, write_concern=None, read_concern=None, full_result=False, **update):
+        name = self._document.__name__
+        touched = updatedFields(self._document, update)
+        wanted = events.wantedFields(name, 'update', touched)
+        ids = idsFromQuery(self._query)
+        before = snapshot(self, ids, wanted)
+        if wanted and ids is None:
+            ids = [doc['_id'] for doc in before]
+        # always ask for the full result, it is the only place the _id of an upserted
+        # document is. The caller gets what they asked for.
+        result = super().update(upsert=upsert, multi=multi, write_concern=write_concern,
+            read_concern=read_concern, full_result=True, **update)
+        if upsert and not ids and result.upserted_id is not None:
+            ids = [result.upserted_id]
+        # The after snapshot is read by _id, not with this queryset's filter: after
+        # .objects(tag='x').update(set__tag='y') nothing matches tag='x' any more.
+        after = snapshot(self._document.objects, ids, wanted) if ids is not None else []
+        events.publish(Change(name, 'update', ids, touched, before, after))
+        if full_result:
+            return result
+        return result.raw_result['n'] if result.raw_result else None
+
+    def modify(self, upsert=False, full_response=False, remove=False, new=False, **update):
+        name = self._document.__name__
+        touched = updatedFields(self._document, update)
+        result = super().modify(upsert=upsert, full_response=full_response, remove=remove, new=new, **update)
+        doc = result.get('value') if full_response else result
+        ids = [doc.id] if doc is not None and not full_response else idsFromQuery(self._query)
+        events.publish(Change(name, 'delete' if remove else 'update', ids, None if remove else touched))
+        return result
+
+    def insert(self, doc_or_docs, load_bulk=True, write_concern=None, signal_kwargs=None):
+        name = self._document.__name__
+        result = super().insert(doc_or_docs, load_bulk=load_bulk, write_concern=write_concern, signal_kwargs=signal_kwargs)
+        docs = result if isinstance(result, list) else [result]
+        ids = [doc.id if load_bulk else doc for doc in docs]
+        wanted = events.wantedFields(name, 'insert')
+        events.publish(Change(name, 'insert', ids, after=snapshot(self, ids, wanted)))
+        return result
+
+    def delete(self, write_concern=None, _from_doc_delete=False, cascade_refs=None):
+        name = self._document.__name__
+        wanted = events.wantedFields(name, 'delete')
+        ids = idsFromQuery(self._query)
+        before = snapshot(self, None, wanted | {'id'}) if wanted else []
+        if wanted:
+            ids = [doc['_id'] for doc in before]
+        result = super().delete(write_concern=write_concern, _from_doc_delete=_from_doc_delete, cascade_refs=cascade_refs)
+        events.publish(Change(name, 'delete', ids, before=before))
+        return result
+
+class EventDocument(Document):
+    meta = {
+        'abstract': True,
+        'queryset_class': EventQuerySet
+    }
+
+    # update() and delete() on one document go through this queryset. mongoengine uses
+    # a plain QuerySet here no matter what queryset_class says.
+    @property
+    def _qs(self):
+        return EventQuerySet(self.__class__, self._get_collection())
+
+    # save() writes to the collection itself instead of going through the queryset
+    def save(self, *args, **kwargs):
+        name = self.__class__.__name__
+        created = self.pk is None or self._created or kwargs.get('force_insert', False)
+        touched = None if created else set(field.split('.')[0] for field in self._get_changed_fields())
+        wanted = events.wantedFields(name, 'insert' if created else 'update', touched)
+        before = [] if created else snapshot(self.__class__.objects, [self.pk], wanted)
+        result = super().save(*args, **kwargs)
+        after = [{key: value for key, value in self.to_mongo().items() if key == '_id' or key in wanted}] if wanted else []
+        events.publish(Change(name, 'insert' if created else 'update', [self.pk], touched, before, after))
+        return result
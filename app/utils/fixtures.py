@@ -0,0 +1,171 @@
+# Made up data for tests, benchmarks and trying the app out without a real database.
+# seedFixtures() empties every collection and fills all of them: students (the first
+# few with a profile picture in GridFS), their sleeps, blogs and their tag counts,
+# comments with replies, clinics with their saved address lookups, old Responses,
+# puzzle sessions and the leaderboard totals for them.
+#
+# The same seed always makes the same data, so two runs can be compared. It is used
+# by 'flask seed-fixtures', by MONGO_FIXTURES=1 (see app/__init__.py) and by
+# benchmarks/routes.py. NEVER run it against the real database: it deletes everything.
+
+import datetime as dt
+import os
+import random
+from bson.objectid import ObjectId
+from app import app
+from app.classes.data import allDocuments, User, Sleep, Blog, Comment, Clinic, Response, PuzzleSession, PuzzleStats, Attempt, Geocode
+from app.classes.puzzles import puzzleBank
+from app.utils.commenttree import commentPath
+from app.utils.events import events
+from app.utils.geocode import normalizeAddress
+
+TAGS = ['sleep', 'puzzles', 'homework', 'games', 'music', 'sports', 'food', 'books']
+PICTURE = os.path.join(app.root_path, 'static', 'bdog.png')
+
+def clearDatabase():
+    for document in allDocuments:
+        document.drop_collection()
+
+def seedUsers(rng, count, pictures):
+    users = User.objects.insert([User(
+            email = f"student{i}@fixtures.test",
+            fname = f"First{i}",
+            lname = f"Last{i}",
+            gname = f"First{i} Last{i}",
+            role = 'student',
+            age = rng.randint(11, 14),
+            consent = True
+        ) for i in range(count)])
+    if pictures:
+        # the picture and its smaller copies go in GridFS the same way the profile
+        # form puts them there. See routes/user.py
+        from app.utils.images import imageSizes, makeThumbnail
+        with open(PICTURE, 'rb') as file:
+            data = file.read()
+        thumbnails = {size: makeThumbnail(data, width) for size, width in imageSizes.items()}
+        for user in users[:pictures]:
+            user.image.put(data, content_type='image/png')
+            for size, thumbnail in thumbnails.items():
+                getattr(user, 'image_' + size).put(thumbnail, content_type='image/jpeg')
+            user.save()
+    return users
+
+def seedSleeps(rng, users, perUser):
+    now = dt.datetime.utcnow().replace(hour=21, minute=0, second=0, microsecond=0)
+    sleeps = []
+    for user in users:
+        for day in range(perUser):
+            start = now - dt.timedelta(days=day + 1, minutes=rng.randint(-60, 180))
+            hours = rng.uniform(5, 10)
+            sleeps.append(Sleep(
+                sleeper = user,
+                rating = rng.randint(1, 5),
+                feel = rng.randint(1, 5),
+                start = start,
+                end = start + dt.timedelta(hours=hours),
+                sleep_date = dt.datetime.combine(start.date(), dt.time()),
+                hours = round(hours, 2),
+                minstosleep = rng.randint(0, 60)
+            ))
+    if sleeps:
+        Sleep.objects.insert(sleeps, load_bulk=False)
+    return len(sleeps)
+
+def seedBlogs(rng, users, count):
+    if not count:
+        return []
+    now = dt.datetime.utcnow()
+    # TagCount is kept up by a subscriber in utils/tags.py as these are added
+    return Blog.objects.insert([Blog(
+            author = rng.choice(users),
+            subject = f"Blog {i} about {rng.choice(TAGS)}",
+            content = ' '.join(rng.choice(TAGS) for _ in range(40)),
+            tag = rng.choice(TAGS),
+            create_date = now - dt.timedelta(minutes=i)
+        ) for i in range(count)])
+
+# perBlog comments on each blog, and replies to about a third of them
+def seedComments(rng, users, blogs, perBlog):
+    comments = []
+    for blog in blogs:
+        parents = []
+        for _ in range(perBlog):
+            parent = rng.choice(parents) if parents and rng.random() < 0.3 else None
+            comment = Comment(id=ObjectId(), author=rng.choice(users), blog=blog, content='A comment')
+            comment.path, comment.depth = commentPath(comment.id, parent)
+            comment.comment = parent
+            comments.append(comment)
+            parents.append(comment)
+    if comments:
+        Comment.objects.insert(comments, load_bulk=False)
+    return len(comments)
+
+# Clinics around Oakland, each with the address lookup it would have needed
+def seedClinics(rng, users, count):
+    clinics, lookups = [], []
+    for i in range(count):
+        lat, lon = rng.uniform(37.6, 38.0), rng.uniform(-122.4, -122.0)
+        clinic = Clinic(author=rng.choice(users), name=f"Clinic {i}", streetAddress=f"{i} Main St", city='Oakland',
+            state='CA', zipcode='94612', description='Sleep clinic', lat=lat, lon=lon, location=[lon, lat], geostatus='found')
+        clinics.append(clinic)
+        lookups.append(Geocode(address=normalizeAddress(clinic.streetAddress, clinic.city, clinic.state, clinic.zipcode),
+            found=True, lat=lat, lon=lon))
+    if clinics:
+        Clinic.objects.insert(clinics, load_bulk=False)
+        Geocode.objects.insert(lookups, load_bulk=False)
+    return len(clinics)
+
+def seedResponses(rng, users, count):
+    puzzleSet = puzzleBank.sets['1']
+    responses = []
+    for _ in range(count):
+        answers = [rng.choice(['2', '3', 'ocean', 'no idea']) for _ in puzzleSet.questions]
+        responses.append(Response(author=rng.choice(users), puzzleset=puzzleSet.id,
+            questions=[question.q for question in puzzleSet.questions], answers=answers,
+            score=sum(1 for question, answer in zip(puzzleSet.questions, answers) if question.check(answer))))
+    if responses:
+        Response.objects.insert(responses, load_bulk=False)
+    return len(responses)
+
+# perUser finished sessions for every student and the leaderboard totals that go with them
+def seedPuzzleSessions(rng, users, perUser):
+    sets = list(puzzleBank.sets.values())
+    sessions, stats = [], []
+    for user in users:
+        scores, attempts = [], 0
+        for _ in range(perUser):
+            puzzleSet = rng.choice(sets)
+            tries = [Attempt(puzzleset=puzzleSet.id, question=question.id, q=question.q,
+                answer=answer, correct=question.check(answer))
+                for question in puzzleSet.questions for answer in [rng.choice(['2', '3', 'ocean', 'flower'])]]
+            score = sum(1 for attempt in tries if attempt.correct)
+            sessions.append(PuzzleSession(author=user, open=False, attempts=tries, score=score))
+            scores.append(score)
+            attempts += len(tries)
+        if scores:
+            stats.append(PuzzleStats(user=user, sessions=len(scores), attempts=attempts,
+                correct=sum(scores), best_score=max(scores)))
+    if sessions:
+        PuzzleSession.objects.insert(sessions, load_bulk=False)
+        PuzzleStats.objects.insert(stats, load_bulk=False)
+    return len(sessions)
+
+def seedFixtures(users=20, sleeps=30, blogs=100, comments=5, clinics=50, responses=50, sessions=3, pictures=1, seed=1):
+    rng = random.Random(seed)
+    clearDatabase()
+    madeUsers = seedUsers(rng, users, pictures)
+    if not madeUsers:
+        return {'users': []}
+    madeBlogs = seedBlogs(rng, madeUsers, blogs)
+    counts = {
+        'users': madeUsers,
+        'blogs': madeBlogs,
+        'sleeps': seedSleeps(rng, madeUsers, sleeps),
+        'comments': seedComments(rng, madeUsers, madeBlogs, comments),
+        'clinics': seedClinics(rng, madeUsers, clinics),
+        'responses': seedResponses(rng, madeUsers, responses),
+        'sessions': seedPuzzleSessions(rng, madeUsers, sessions),
+    }
+    # wait for the background subscribers (the tag counts) to catch up
+    events.flush()
+    return counts
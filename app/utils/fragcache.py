@@ -0,0 +1,149 @@
+# The list pages (blogs, clinics, puzzles and sleeps) are read far more often than
+# they change. This cache keeps the rendered html of each page of each list so most
+# requests skip both the MongoDB queries and the template.
+#
+# Every list has a namespace like 'blogs'. A key is the namespace, its "generation",
+# the route, the ?after=/?before= cursor (all of the url's args really) and a variant
+# for lists that look different for different users. When a blog changes,
+# fragmentCache.invalidate('blogs') adds 1 to the generation. Every old key for blogs
+# is then never asked for again and the old html just ages out. listFragments below
+# says which changes make which lists be rendered again. See utils/events.py
+#
+# There are two places to keep the html:
+#   MemoryBackend - in this process, least recently used is thrown away once the
+#                   html adds up to FRAGMENT_CACHE_BYTES and nothing is kept longer
+#                   than FRAGMENT_CACHE_TTL seconds. Each process has its own, and a
+#                   change only invalidates the copy in the process that made it.
+#                   With several gunicorn workers the others can show the old page
+#                   for up to FRAGMENT_CACHE_TTL seconds, so use redis for those.
+#   RedisBackend  - a redis server (FRAGMENT_CACHE_URL=redis://localhost:6379/0)
+#                   shared by every process. Needs 'pip install redis'.
+
+import threading
+import time
+from collections import OrderedDict
+from flask import request, render_template
+from markupsafe import Markup
+from app import app
+from app.utils.events import events
+
+class MemoryBackend:
+    def __init__(self, maxbytes, ttl):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.size = 0
+        # key: (the time it expires, html)
+        self.items = OrderedDict()
+        # generations are kept apart from the html so they are never thrown away
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires <= time.monotonic():
+                del self.items[key]
+                self.size -= len(value)
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (ttl or self.ttl)
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.items[key] = (expires, value)
+            self.size += len(value)
+            while self.size > self.maxbytes and self.items:
+                _, (_, dropped) = self.items.popitem(last=False)
+                self.size -= len(dropped)
+
+    def incr(self, key):
+        with self.lock:
+            self.generations[key] = self.generations.get(key, 0) + 1
+            return self.generations[key]
+
+    def generation(self, key):
+        return self.generations.get(key, 0)
+
+class RedisBackend:
+    def __init__(self, url, ttl):
+        # only imported when redis is being used
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value.encode('utf-8'), ex=ttl or self.ttl)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+    def generation(self, key):
+        return int(self.client.get(key) or 0)
+
+class FragmentCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, namespace, variant, *parts):
+        generation = self.backend.generation(f"gen:{namespace}")
+        return '|'.join([namespace, str(generation), str(variant)] + [str(part) for part in parts])
+
+    def invalidate(self, *namespaces):
+        for namespace in namespaces:
+            self.backend.incr(f"gen:{namespace}")
+
+    # load() does the queries and returns the variables for the template. It is only
+    # called when the html isn't in the cache. The key is made BEFORE rendering so if a
+    # blog is saved while this is rendering the html is stored under the old generation
+    # and nobody will ever see it.
+    def render(self, namespace, template, load, variant='all'):
+        args = sorted(request.args.items(multi=True))
+        key = self.key(namespace, variant, request.endpoint, args)
+        html = self.backend.get(key)
+        if html is None:
+            self.misses += 1
+            html = render_template(template, **load())
+            self.backend.set(key, html)
+        else:
+            self.hits += 1
+        return Markup(html)
+
+def makeFragmentCache():
+    if app.config['FRAGMENT_CACHE_URL']:
+        return FragmentCache(RedisBackend(app.config['FRAGMENT_CACHE_URL'], app.config['FRAGMENT_CACHE_TTL']))
+    return FragmentCache(MemoryBackend(app.config['FRAGMENT_CACHE_BYTES'], app.config['FRAGMENT_CACHE_TTL']))
+
+fragmentCache = makeFragmentCache()
+
+# Which lists show which documents. A list with names on it also has to be rendered
+# again when a user's name changes.
+listFragments = {
+    'Blog': ('blogs', ()),
+    'Clinic': ('clinics', ()),
+    'PuzzleSession': ('puzzles', ()),
+    'Sleep': ('sleeps', ()),
+    'User': (('blogs', 'sleeps'), ('fname', 'lname')),
+}
+
+def subscribeList(document, namespaces, fields):
+    namespaces = (namespaces,) if isinstance(namespaces, str) else namespaces
+    # sync=True so the page the route redirects to already shows the change
+    @events.subscribe(document, fields=fields, sync=True)
+    def invalidateList(changes):
+        fragmentCache.invalidate(*namespaces)
+
+for document, (namespaces, fields) in listFragments.items():
+    subscribeList(document, namespaces, fields)
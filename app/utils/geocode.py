@@ -0,0 +1,148 @@
+# Turns clinic addresses into lat/lon for the map. Looking up an address on
+# nominatim.openstreetmap.org can take seconds, so the routes don't wait for it.
+# They put the clinic on a queue and a background thread does the lookups one at a
+# time, no faster than Nominatim's rule of 1 request per second. That limit is kept
+# in MongoDB so it holds for all the gunicorn workers together. Every answer is
+# saved in the Geocode collection so the same address is never looked up twice,
+# except that refresh=True asks again about an address that wasn't found last time.
+#
+# The queue is in memory, so lookups waiting in it when a worker restarts are lost.
+# 'flask geocode-clinics' looks up every clinic that is still pending or failed.
+#
+# Set GEOCODER=stub to use a pretend geocoder that never touches the internet.
+
+import datetime as dt
+import hashlib
+import queue
+import re
+import threading
+import time
+from app import app
+import mongoengine.errors
+from app.classes.data import Clinic, Geocode, RateLimit
+from app.utils.http import httpSession, httpTimeout
+from app.utils.settings import setting
+
+# "123  Main St.," and "123 main st" are the same address
+def normalizeAddress(street, city, state, zipcode):
+    address = " ".join(part or "" for part in (street, city, state, zipcode))
+    address = re.sub(r"[.,#]", " ", address.lower())
+    return " ".join(address.split())
+
+class SharedRateLimiter:
+    # Makes callers wait so wait() returns at most perSecond times a second, counted
+    # across every process using the same database. Each wait() claims the next time
+    # slot by moving RateLimit.next on by one interval, but only if that time has
+    # come. If another process got there first it sleeps until then. (The workers'
+    # clocks have to agree, which they do on one server.)
+    def __init__(self, name, perSecond):
+        self.name = name
+        self.interval = dt.timedelta(seconds=1 / perSecond)
+
+    def wait(self):
+        while True:
+            now = dt.datetime.utcnow()
+            try:
+                # the upsert makes the row the first time. If the row is there but
+                # its time hasn't come the upsert tries to make a second one with the
+                # same name, which MongoDB refuses.
+                RateLimit.objects(name=self.name, next__lte=now).modify(upsert=True, new=True, set__next=now + self.interval)
+                return
+            except mongoengine.errors.NotUniqueError:
+                pass
+            limit = RateLimit.objects(name=self.name).first()
+            time.sleep(max(0.01, (limit.next - now).total_seconds()) if limit else 0.01)
+
+class NominatimGeocoder:
+    def __init__(self, perSecond):
+        self.limiter = SharedRateLimiter('nominatim', perSecond)
+        self.email = setting('MY_EMAIL_ADDRESS')
+
+    # Returns (lat, lon) or None if the address wasn't found. Raises an error if
+    # Nominatim couldn't be reached so the lookup can be tried again.
+    def lookup(self, street, city, state, zipcode):
+        self.limiter.wait()
+        r = httpSession().get("https://nominatim.openstreetmap.org/search",
+            params = {'street': street, 'city': city, 'state': state, 'postalcode': zipcode,
+                'format': 'json', 'email': self.email},
+            headers = {'User-Agent': f"PuzzlesApp ({self.email})"},
+            timeout = httpTimeout)
+        r.raise_for_status()
+        results = r.json()
+        if len(results) == 0:
+            return None
+        return float(results[0]['lat']), float(results[0]['lon'])
+
+class StubGeocoder:
+    # Always answers right away with a made up spot near Oakland Tech. The same
+    # address always gets the same spot.
+    def lookup(self, street, city, state, zipcode):
+        digest = hashlib.sha1(normalizeAddress(street, city, state, zipcode).encode('utf-8')).digest()
+        return 37.8323039 + (digest[0] - 128) / 2000, -122.2575883 + (digest[1] - 128) / 2000
+
+def makeGeocoder():
+    if app.config['GEOCODER'] == 'stub':
+        return StubGeocoder()
+    return NominatimGeocoder(app.config['GEOCODE_RATE'])
+
+# refresh=True ignores a saved "not found" and asks the geocoder again
+def geocodeClinic(clinicID, geocoder, refresh=False):
+    # only imported once there is an address to look up
+    import requests
+    clinic = Clinic.objects(id=clinicID).first()
+    if clinic is None:
+        return
+    address = normalizeAddress(clinic.streetAddress, clinic.city, clinic.state, clinic.zipcode)
+
+    cached = Geocode.objects(address=address).first()
+    if cached is None or (refresh and not cached.found):
+        for attempt in range(app.config['GEOCODE_RETRIES'] + 1):
+            try:
+                found = geocoder.lookup(clinic.streetAddress, clinic.city, clinic.state, clinic.zipcode)
+                break
+            except (requests.RequestException, ValueError, KeyError) as error:
+                app.logger.warning(f"Geocoding '{address}' failed: {error}")
+                # wait 1, 2, 4... seconds before trying again, but not after the last try
+                if attempt < app.config['GEOCODE_RETRIES']:
+                    time.sleep(2 ** attempt)
+        else:
+            clinic.update(geostatus='failed')
+            return
+        lat, lon = found or (None, None)
+        # upsert so two lookups of the same new address can't both insert it
+        Geocode.objects(address=address).update_one(upsert=True,
+            set__found=found is not None, set__lat=lat, set__lon=lon, set__createdate=dt.datetime.utcnow())
+        cached = Geocode(address=address, found=found is not None, lat=lat, lon=lon)
+
+    if cached.found:
+        clinic.update(lat=cached.lat, lon=cached.lon, location=[cached.lon, cached.lat], geostatus='found')
+    else:
+        clinic.update(geostatus='notfound')
+
+class GeocodeQueue:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    # The routes call this. It returns right away.
+    def add(self, clinic, refresh=False):
+        with self.lock:
+            # the thread is started the first time it is needed
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.queue.put((clinic.id, refresh))
+
+    def run(self):
+        geocoder = makeGeocoder()
+        while True:
+            clinicID, refresh = self.queue.get()
+            try:
+                geocodeClinic(clinicID, geocoder, refresh)
+            except Exception:
+                app.logger.exception(f"Geocoding clinic {clinicID} failed")
+            finally:
+                self.queue.task_done()
+
+geocodeQueue = GeocodeQueue()
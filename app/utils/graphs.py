@@ -0,0 +1,83 @@
+# This is where the sleep graph is drawn. Each user gets their own graph that is
+# drawn in memory with the matplotlib Figure object instead of pyplot. pyplot keeps
+# one global "current figure" which is not safe when two requests draw at the same
+# time, and the old code wrote every user's graph to the same file in static/.
+# matplotlib takes a long time to import so it is only imported the first time a
+# graph is drawn, not when the app starts.
+# Finished graphs are remembered by a hash of the data they were drawn from so an
+# unchanged sleep history is never drawn twice.
+
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from app import app
+
+class GraphCache:
+    # A small least-recently-used cache of png bytes keyed by the data hash.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            png = self.items.get(key)
+            if png is not None:
+                self.items.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return png
+
+    def put(self, key, png):
+        with self.lock:
+            self.items[key] = png
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+graphCache = GraphCache(app.config['GRAPH_CACHE_SIZE'])
+
+# rows is a list of (start, hours, rating) tuples. The hash is also used as the ETag
+# so a browser that already has this graph gets a 304 and nothing is drawn or sent.
+def sleepDigest(rows):
+    digest = hashlib.sha1()
+    for start, hours, rating in rows:
+        digest.update(f"{start.isoformat()}|{hours}|{rating};".encode('utf-8'))
+    return digest.hexdigest()
+
+def drawSleepGraph(rows):
+    from matplotlib.figure import Figure
+    hours = []
+    dates = []
+    colors = []
+    for start, hour, rating in rows:
+        hours.append(hour)
+        dates.append(start.date())
+        if rating and rating >= 4:
+            colors.append('green')
+        elif rating == 3:
+            colors.append('yellow')
+        else:
+            colors.append('red')
+
+    fig = Figure(figsize=(10, 5))
+    ax = fig.subplots()
+    ax.scatter(dates, hours, marker='o', c=colors)
+    ax.set_yticks(hours)
+    ax.set_xticks(dates)
+    ax.tick_params(axis='x', labelrotation=45)
+
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches="tight")
+    return buffer.getvalue()
+
+def sleepGraph(digest, rows):
+    png = graphCache.get(digest)
+    if png is None:
+        png = drawSleepGraph(rows)
+        graphCache.put(digest, png)
+    return png
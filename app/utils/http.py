@@ -0,0 +1,67 @@
+# One shared requests Session for the calls this app makes to other websites (Google
+# login, the map address lookup). A Session keeps connections open in a pool so the
+# next call to the same site skips the connection and TLS handshake. Always pass
+# timeout=httpTimeout so a slow website can't hang one of our requests forever.
+# httpSession() makes the Session (and imports requests) the first time it's needed.
+
+import threading
+import time
+from app import app
+
+_session = None
+_sessionLock = threading.Lock()
+
+def httpSession():
+    global _session
+    if _session is None:
+        with _sessionLock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=10, pool_maxsize=app.config['HTTP_POOL_SIZE'])
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+# (seconds to connect, seconds to wait for the answer)
+httpTimeout = (app.config['HTTP_TIMEOUT'], app.config['HTTP_TIMEOUT'])
+
+class RefreshingValue:
+    # Remembers the result of fetch() for ttl seconds. After that the old value is
+    # still returned right away while a background thread gets a new one, so only
+    # the very first caller ever has to wait for fetch().
+    def __init__(self, fetch, ttl):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.value = None
+        self.fetched = 0
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.value is None:
+            with self.lock:
+                if self.value is None:
+                    self.value = self.fetch()
+                    self.fetched = time.monotonic()
+            return self.value
+
+        if time.monotonic() - self.fetched > self.ttl:
+            with self.lock:
+                startRefresh = not self.refreshing
+                self.refreshing = True
+            if startRefresh:
+                threading.Thread(target=self.refresh, daemon=True).start()
+        return self.value
+
+    def refresh(self):
+        try:
+            self.value = self.fetch()
+            self.fetched = time.monotonic()
+        except Exception as error:
+            # keep using the old value and try again on the next get()
+            app.logger.warning(f"Unable to refresh {self.fetch.__name__}: {error}")
+        finally:
+            self.refreshing = False
@@ -0,0 +1,26 @@
+# Helpers for profile pictures. When a picture is uploaded smaller copies are made
+# right away so a page that shows a tiny picture doesn't have to send the whole photo.
+
+from io import BytesIO
+
+# name of the size: width in pixels. Each size is stored in User.image_<name>
+imageSizes = {'small': 120, 'medium': 300}
+
+def makeThumbnail(data, width):
+    # Pillow is only needed when someone uploads a picture so it isn't loaded until then
+    from PIL import Image
+    image = Image.open(BytesIO(data))
+    image.thumbnail((width, width * 4))
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+# Sends a GridFS file a piece at a time instead of reading the whole file into memory
+def streamFile(gridout, chunkSize=256 * 1024):
+    while True:
+        chunk = gridout.read(chunkSize)
+        if not chunk:
+            break
+        yield chunk
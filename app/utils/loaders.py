@@ -0,0 +1,34 @@
+# When a template shows {{blog.author.fname}} for every blog in a list, mongoengine
+# goes back to the database once for EVERY blog to get its author. 20 blogs means 21
+# queries. attachReferences() gets all of the authors for the whole list in one query
+# and puts them on the documents before the template runs. 20 blogs means 2 queries.
+
+from bson.dbref import DBRef
+from mongoengine import Document
+
+def referenceId(value):
+    # A reference can be stored as a DBRef, a plain ObjectId or an already loaded document
+    if isinstance(value, DBRef):
+        return value.id
+    if isinstance(value, Document):
+        return value.pk
+    return value
+
+# docs: a list of documents, field: the name of the ReferenceField on them, document: the
+# class it points to, only: the fields the template actually shows
+def attachReferences(docs, field, document, only=None):
+    ids = {referenceId(doc._data.get(field)) for doc in docs}
+    ids.discard(None)
+    if not ids:
+        return docs
+
+    found = document.objects(id__in=list(ids))
+    if only:
+        found = found.only(*only)
+    found = {ref.pk: ref for ref in found}
+
+    for doc in docs:
+        ref = found.get(referenceId(doc._data.get(field)))
+        if ref is not None:
+            setattr(doc, field, ref)
+    return docs
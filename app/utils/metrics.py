@@ -0,0 +1,358 @@
+# Timing for every request, kept per route (the "endpoint", which is the name of the
+# route's function like 'blogList'). /metrics shows all of it in the text format that
+# Prometheus reads (https://prometheus.io/docs/instrumenting/exposition_formats/):
+#
+#   http_request_duration_seconds   how long requests took, as a histogram
+#   mongo_queries_per_request       how many MongoDB commands each request sent
+#   mongo_query_seconds_total       time spent waiting on MongoDB
+#   mongo_documents_returned_total  documents MongoDB sent back
+#   mongo_queries_per_document      see N+1 below
+#   cache_hits_total and cache_misses_total for the caches in utils/
+#
+# N+1: a route that sends one more query for every row it shows (like looking up the
+# author of every blog one at a time) gets slower as the lists grow. For each route the
+# last METRICS_SAMPLES requests are remembered as (documents returned, queries sent).
+# The slope of the line through them is how many extra queries each extra document
+# costs. A route with a constant number of queries has a slope near 0, a route that
+# looks something up for every row has a slope of about 0.5 (one query and one more
+# document per row). Routes over N_PLUS_ONE_SLOPE are logged once and marked with
+# mongo_n_plus_one 1.
+#
+# SLOW_REQUEST_MS logs every request that takes longer than that many milliseconds.
+#
+# Several processes: every gunicorn worker keeps its own numbers and a request for
+# /metrics goes to any one of them. With METRICS_DIR set (gunicorn.conf.py sets it)
+# each worker saves its numbers to a file in that folder every METRICS_FLUSH_SECONDS
+# and /metrics adds up the files of all the workers. Workers that have stopped still
+# count (their totals are moved into archive.json) so the counters never go down.
+# Gauges can't be added up, so they get a worker="<pid>" label and only running
+# workers are shown. Each worker spots N+1 queries in the requests it handled.
+
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from flask import g, request
+from app import app
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def formatNumber(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    def __init__(self, name, help, kind):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    # The values as something json can save: a list of [labels, value]
+    def dump(self):
+        with self.lock:
+            return [[list(map(list, key)), value] for key, value in self.values.items()]
+
+    # Adds up the values saved by several processes. Counters just add.
+    def merge(self, dumps, live=None):
+        merged = {}
+        for pid, values in dumps:
+            for labels, value in values:
+                key = tuple(map(tuple, labels))
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+class Counter(Metric):
+    def __init__(self, name, help):
+        super().__init__(name, help, 'counter')
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def lines(self, values=None):
+        if values is None:
+            with self.lock:
+                values = dict(self.values)
+        return [f"{self.name}{formatLabels(dict(key))} {formatNumber(value)}" for key, value in sorted(values.items())]
+
+# kind='counter' is for counts that are kept somewhere else and copied in with set()
+class Gauge(Counter):
+    def __init__(self, name, help, kind='gauge'):
+        Metric.__init__(self, name, help, kind)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    # A gauge from another process can't be added to this one's, so each running
+    # worker's value is shown with its own worker label
+    def merge(self, dumps, live=None):
+        if self.kind == 'counter':
+            return super().merge(dumps)
+        merged = {}
+        for pid, values in dumps:
+            if live is not None and pid not in live:
+                continue
+            for labels, value in values:
+                merged[tuple(sorted(map(tuple, labels + [['worker', str(pid)]])))] = value
+        return merged
+
+class Histogram(Metric):
+    def __init__(self, name, help, buckets=BUCKETS):
+        super().__init__(name, help, 'histogram')
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    def merge(self, dumps, live=None):
+        merged = {}
+        for pid, values in dumps:
+            for labels, (counts, total) in values:
+                key = tuple(map(tuple, labels))
+                oldCounts, oldTotal = merged.get(key, ([0] * len(counts), 0))
+                merged[key] = ([a + b for a, b in zip(oldCounts, counts)], oldTotal + total)
+        return merged
+
+    def dump(self):
+        with self.lock:
+            return [[list(map(list, key)), [list(counts), total]] for key, (counts, total) in self.values.items()]
+
+    def lines(self, values=None):
+        if values is None:
+            with self.lock:
+                values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            labels = dict(key)
+            running = 0
+            for bound, count in zip(self.buckets, counts):
+                running += count
+                lines.append(f"{self.name}_bucket{formatLabels({**labels, 'le': formatNumber(bound)})} {running}")
+            lines.append(f"{self.name}_sum{formatLabels(labels)} {formatNumber(float(total))}")
+            lines.append(f"{self.name}_count{formatLabels(labels)} {running}")
+        return lines
+
+def pidAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Registry:
+    def __init__(self, directory=None):
+        self.metrics = []
+        # functions called when /metrics is read, for numbers kept somewhere else
+        self.collectors = []
+        # METRICS_DIR, or None when this process is the only one
+        self.directory = directory
+        self.writerPid = None
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self):
+        for collect in self.collectors:
+            collect()
+
+    def render(self):
+        self.collect()
+        lines = []
+        if self.directory:
+            self.save()
+            merged = self.mergeFiles()
+            for metric in self.metrics:
+                lines += metric.header() + metric.lines(merged.get(metric.name, {}))
+        else:
+            for metric in self.metrics:
+                lines += metric.header() + metric.lines()
+        return '\n'.join(lines) + '\n'
+
+    # --- METRICS_DIR, for several processes ---
+
+    def fileFor(self, pid):
+        return os.path.join(self.directory, f"worker-{pid}.json")
+
+    # Saves this process's numbers. The file is replaced all at once so it is never
+    # read half written.
+    def save(self):
+        self.collect()
+        pid = os.getpid()
+        data = {metric.name: metric.dump() for metric in self.metrics}
+        os.makedirs(self.directory, exist_ok=True)
+        temp = self.fileFor(pid) + '.tmp'
+        with open(temp, 'w') as file:
+            json.dump(data, file)
+        os.replace(temp, self.fileFor(pid))
+
+    # Saves every METRICS_FLUSH_SECONDS on a thread in each worker. Threads don't
+    # survive fork() so it is started by the first request a worker handles.
+    def startSaving(self):
+        if not self.directory or self.writerPid == os.getpid():
+            return
+        self.writerPid = os.getpid()
+        def run():
+            while True:
+                time.sleep(app.config['METRICS_FLUSH_SECONDS'])
+                try:
+                    self.save()
+                except OSError as error:
+                    app.logger.warning(f"Unable to save metrics: {error}")
+        threading.Thread(target=run, daemon=True).start()
+        atexit.register(self.save)
+
+    def readFile(self, path):
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    # Reads every worker's file. The files of workers that have stopped are added into
+    # archive.json and deleted, under a lock so two workers can't both add one in.
+    def mergeFiles(self):
+        archivePath = os.path.join(self.directory, 'archive.json')
+        with open(os.path.join(self.directory, 'lock'), 'w') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            workers = {}
+            for name in os.listdir(self.directory):
+                if name.startswith('worker-') and name.endswith('.json'):
+                    pid = int(name[len('worker-'):-len('.json')])
+                    workers[pid] = self.readFile(os.path.join(self.directory, name))
+            live = {pid for pid in workers if pidAlive(pid)}
+            dead = [pid for pid in workers if pid not in live]
+            archive = self.readFile(archivePath)
+            if dead:
+                for metric in self.metrics:
+                    if isinstance(metric, Gauge) and metric.kind == 'gauge':
+                        continue
+                    dumps = [(0, archive.get(metric.name, []))] + [(pid, workers[pid].get(metric.name, [])) for pid in dead]
+                    archive[metric.name] = [[list(map(list, key)), value] for key, value in metric.merge(dumps).items()]
+                temp = archivePath + '.tmp'
+                with open(temp, 'w') as file:
+                    json.dump(archive, file)
+                os.replace(temp, archivePath)
+                for pid in dead:
+                    os.remove(self.fileFor(pid))
+        merged = {}
+        for metric in self.metrics:
+            dumps = [(0, archive.get(metric.name, []))] + [(pid, workers[pid].get(metric.name, [])) for pid in live]
+            merged[metric.name] = metric.merge(dumps, live)
+        return merged
+
+registry = Registry(app.config['METRICS_DIR'] or None)
+requestDuration = registry.add(Histogram('http_request_duration_seconds', 'Time to answer a request'))
+requestQueries = registry.add(Histogram('mongo_queries_per_request', 'MongoDB commands sent by one request', QUERY_BUCKETS))
+queryTime = registry.add(Counter('mongo_query_seconds_total', 'Time spent waiting for MongoDB'))
+docsReturned = registry.add(Counter('mongo_documents_returned_total', 'Documents MongoDB sent back'))
+queriesPerDocument = registry.add(Gauge('mongo_queries_per_document', 'Extra queries a route sends for each extra document it reads'))
+nPlusOne = registry.add(Gauge('mongo_n_plus_one', '1 if the number of queries a route sends grows with the documents it reads'))
+cacheHits = registry.add(Gauge('cache_hits_total', 'Times a cache had what was asked for', kind='counter'))
+cacheMisses = registry.add(Gauge('cache_misses_total', "Times a cache didn't have what was asked for", kind='counter'))
+
+class ScalingTracker:
+    # Remembers (documents, queries) for the last few requests of every route
+    def __init__(self, samples):
+        self.samples = defaultdict(lambda: deque(maxlen=samples))
+        self.flagged = set()
+        self.lock = threading.Lock()
+
+    def add(self, endpoint, docs, queries):
+        with self.lock:
+            self.samples[endpoint].append((docs, queries))
+            points = list(self.samples[endpoint])
+        slope = self.slope(points)
+        if slope is None:
+            return
+        queriesPerDocument.set(round(slope, 3), endpoint=endpoint)
+        flagged = slope >= app.config['N_PLUS_ONE_SLOPE']
+        nPlusOne.set(1 if flagged else 0, endpoint=endpoint)
+        if flagged and endpoint not in self.flagged:
+            self.flagged.add(endpoint)
+            app.logger.warning(f"{endpoint} looks like an N+1: about {slope:.2f} more queries for every document it reads")
+
+    # least squares slope of queries over documents, or None if there isn't enough to go on
+    def slope(self, points):
+        if len(points) < 10 or len(set(docs for docs, _ in points)) < 3:
+            return None
+        meanX = sum(docs for docs, _ in points) / len(points)
+        meanY = sum(queries for _, queries in points) / len(points)
+        spread = sum((docs - meanX) ** 2 for docs, _ in points)
+        return sum((docs - meanX) * (queries - meanY) for docs, queries in points) / spread
+
+scaling = ScalingTracker(app.config['METRICS_SAMPLES'])
+
+@app.before_request
+def startTimer():
+    g.requestStart = time.perf_counter()
+    registry.startSaving()
+
+@app.after_request
+def rememberStatus(response):
+    g.responseStatus = response.status_code
+    return response
+
+# teardown runs even when the route raised an error, after_request doesn't
+@app.teardown_request
+def recordRequest(error=None):
+    start = g.get('requestStart')
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    endpoint = request.endpoint or 'notfound'
+    status = g.get('responseStatus', 500)
+    queries = g.get('queryCount', 0)
+    queryMicros = g.get('queryMicros', 0)
+    docs = g.get('docsReturned', 0)
+
+    requestDuration.observe(elapsed, endpoint=endpoint, method=request.method, status=status)
+    requestQueries.observe(queries, endpoint=endpoint)
+    queryTime.inc(queryMicros / 1000000, endpoint=endpoint)
+    docsReturned.inc(docs, endpoint=endpoint)
+    if status < 400:
+        scaling.add(endpoint, docs, queries)
+
+    slowMs = app.config['SLOW_REQUEST_MS']
+    if slowMs and elapsed * 1000 >= slowMs:
+        app.logger.warning(f"Slow request: {request.method} {request.full_path} ({endpoint}) {status} "
+            f"took {elapsed * 1000:.0f} ms, {queries} queries, {queryMicros / 1000:.0f} ms in MongoDB, {docs} documents")
+
+# The caches keep their own counts. They are copied in whenever /metrics is read.
+def collectCacheStats():
+    from app.utils.usercache import userCache
+    from app.utils.fragcache import fragmentCache
+    from app.utils.graphs import graphCache
+    for name, cache in (('user', userCache), ('fragment', fragmentCache), ('graph', graphCache)):
+        cacheHits.set(cache.hits, cache=name)
+        cacheMisses.set(cache.misses, cache=name)
+
+registry.collectors.append(collectCacheStats)
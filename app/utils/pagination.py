@@ -0,0 +1,49 @@
+# Lists are shown one page at a time. Instead of skip() (which makes MongoDB walk past
+# every row on the earlier pages) each page asks for the rows whose _id comes after the
+# last row of the page before it. _id always has an index so page 500 costs the same
+# as page 1. The _id of the first and last row shown are the "cursors" in the
+# ?after=... and ?before=... links.
+
+from bson.objectid import ObjectId
+from flask import request
+from app import app
+
+class Page:
+    def __init__(self, items, nextCursor=None, prevCursor=None):
+        self.items = items
+        # the _id to put in the ?after= link or None if this is the last page
+        self.nextCursor = nextCursor
+        # the _id to put in the ?before= link or None if this is the first page
+        self.prevCursor = prevCursor
+
+# Newest first. after= goes to older rows, before= goes back to newer rows.
+def keysetPage(queryset, after=None, before=None, size=None):
+    size = size or app.config['PAGE_SIZE']
+    if before:
+        # walk backwards from the cursor then flip the rows back to newest first
+        items = list(queryset.filter(id__gt=before).order_by('id').limit(size + 1))
+        more = len(items) > size
+        items = items[:size]
+        items.reverse()
+        return Page(items,
+            nextCursor = items[-1].id if items else None,
+            prevCursor = items[0].id if more else None)
+
+    if after:
+        queryset = queryset.filter(id__lt=after)
+    # one extra row tells us if there is another page without counting the collection
+    items = list(queryset.order_by('-id').limit(size + 1))
+    more = len(items) > size
+    items = items[:size]
+    return Page(items,
+        nextCursor = items[-1].id if more else None,
+        prevCursor = items[0].id if after and items else None)
+
+# Reads ?after= and ?before= from the url. Anything that isn't an ObjectId is ignored.
+def paginate(queryset, size=None):
+    after = request.args.get('after')
+    before = request.args.get('before')
+    return keysetPage(queryset,
+        after = ObjectId(after) if after and ObjectId.is_valid(after) else None,
+        before = ObjectId(before) if before and ObjectId.is_valid(before) else None,
+        size = size)
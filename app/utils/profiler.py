@@ -0,0 +1,135 @@
+# A sampling profiler for live requests. While a profiled request runs, another thread
+# looks at what the request's thread is doing every PROFILE_INTERVAL_MS milliseconds
+# (sys._current_frames() gives the current stack of every thread) and counts how many
+# times it saw each stack. The request runs at full speed between looks, so this is
+# safe to use on the real server.
+#
+# A request is profiled if:
+#   - it is picked at random, PROFILE_SAMPLE_RATE of the time (0.01 is 1 in 100), or
+#   - it sends the header "X-Profile: <PROFILE_TOKEN>" (only if PROFILE_TOKEN is set)
+#
+# Each profile is saved in PROFILE_DIR in the "collapsed stack" format: one line per
+# stack, callers first, separated by ';' and then how many times it was seen. That is
+# what flamegraph.pl and speedscope.app read to draw a flame graph. Only the newest
+# PROFILE_KEEP files are kept. Admins can list and download them at /admin/profiles.
+
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from flask import g, request
+from app import app
+
+# names look like 20261018-090137-123456-blogList-42ms-1234.collapsed
+PROFILE_NAME = re.compile(r'^[\w.-]+\.collapsed$')
+
+def frameName(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def collapseStack(frame):
+    names = []
+    while frame is not None:
+        names.append(frameName(frame))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+class Sampler:
+    def __init__(self, threadId, interval):
+        self.threadId = threadId
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.threadId)
+            if frame is not None:
+                self.stacks[collapseStack(frame)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.stacks
+
+def profileDir():
+    return app.config['PROFILE_DIR']
+
+# Saves the profile and removes the oldest ones so only PROFILE_KEEP are left
+def saveProfile(endpoint, elapsed, stacks):
+    os.makedirs(profileDir(), exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime()) + f"-{int(time.time() * 1000000) % 1000000:06d}"
+    name = f"{stamp}-{endpoint}-{elapsed * 1000:.0f}ms-{os.getpid()}.collapsed"
+    path = os.path.join(profileDir(), name)
+    with open(path + '.tmp', 'w') as file:
+        for stack, count in stacks.most_common():
+            file.write(f"{stack} {count}\n")
+    # the finished file appears all at once so a download never gets half of it
+    os.replace(path + '.tmp', path)
+    for old in listProfiles()[app.config['PROFILE_KEEP']:]:
+        try:
+            os.remove(os.path.join(profileDir(), old['name']))
+        except FileNotFoundError:
+            # another worker removed it first
+            pass
+    return name
+
+# Newest first
+def listProfiles():
+    try:
+        names = [name for name in os.listdir(profileDir()) if PROFILE_NAME.match(name)]
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in sorted(names, reverse=True):
+        try:
+            size = os.path.getsize(os.path.join(profileDir(), name))
+        except FileNotFoundError:
+            continue
+        parts = name[:-len('.collapsed')].split('-')
+        profiles.append({'name': name, 'size': size, 'endpoint': '-'.join(parts[3:-2]),
+            'time': parts[-2], 'created': f"{parts[0]} {parts[1]}"})
+    return profiles
+
+def shouldProfile():
+    token = app.config['PROFILE_TOKEN']
+    sent = request.headers.get('X-Profile')
+    if token and sent and hmac.compare_digest(sent.encode('utf-8'), token.encode('utf-8')):
+        return True
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
+
+@app.before_request
+def startProfile():
+    if shouldProfile():
+        g.profileStart = time.perf_counter()
+        g.profiler = Sampler(threading.get_ident(), app.config['PROFILE_INTERVAL_MS'] / 1000).start()
+
+@app.after_request
+def finishProfile(response):
+    sampler = g.pop('profiler', None)
+    if sampler is not None:
+        stacks = sampler.stop()
+        elapsed = time.perf_counter() - g.profileStart
+        try:
+            response.headers['X-Profile-Id'] = saveProfile(request.endpoint or 'notfound', elapsed, stacks)
+        except OSError as error:
+            app.logger.warning(f"Unable to save a profile: {error}")
+    return response
+
+# If the route raised an error after_request is skipped. Stop the sampler anyway.
+@app.teardown_request
+def stopProfile(error=None):
+    sampler = g.pop('profiler', None)
+    if sampler is not None:
+        sampler.stop()
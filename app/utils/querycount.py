@@ -0,0 +1,40 @@
+# Counts how many commands each request sends to MongoDB, how long they took and how
+# many documents came back. pymongo tells every registered CommandListener about each
+# command it sends. The count is added to every response as the X-Query-Count header
+# which makes it easy to check that a list page sends the same number of queries no
+# matter how many rows it shows. utils/metrics.py keeps the totals for each route.
+
+from flask import g, has_request_context
+from pymongo import monitoring
+from app import app
+
+# How many documents a command sent back. find and aggregate send a first batch and
+# getMore sends the rest. findAndModify (modify() in mongoengine) sends one or none.
+def documentsReturned(reply):
+    cursor = reply.get('cursor')
+    if cursor:
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+    if 'value' in reply:
+        return 0 if reply['value'] is None else 1
+    return 0
+
+class QueryCounter(monitoring.CommandListener):
+    # pymongo calls these in the same thread that is handling the request. Commands
+    # sent by the background threads aren't part of any request so they aren't counted.
+    def started(self, event):
+        if has_request_context():
+            g.queryCount = g.get('queryCount', 0) + 1
+
+    def succeeded(self, event):
+        if has_request_context():
+            g.queryMicros = g.get('queryMicros', 0) + event.duration_micros
+            g.docsReturned = g.get('docsReturned', 0) + documentsReturned(event.reply)
+
+    def failed(self, event):
+        if has_request_context():
+            g.queryMicros = g.get('queryMicros', 0) + event.duration_micros
+
+@app.after_request
+def addQueryCount(response):
+    response.headers['X-Query-Count'] = str(g.get('queryCount', 0))
+    return response
@@ -0,0 +1,38 @@
+# Helpers for sending a user's sleep history to the browser as numbers instead of
+# a drawn picture. Long histories are shrunk with the "largest triangle three
+# buckets" (LTTB) algorithm which keeps the points that change the shape of the
+# line the most, so a chart of several years still only needs a few hundred points.
+
+def lttb(xs, ys, threshold):
+    # Returns the indexes of the points to keep. xs must be sorted.
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    keep = [0]
+    # the first and last points are always kept, the rest are split into buckets
+    bucketSize = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # the average of the next bucket is the third corner of the triangle
+        nextStart = int((i + 1) * bucketSize) + 1
+        nextEnd = min(int((i + 2) * bucketSize) + 1, n)
+        count = nextEnd - nextStart
+        avgX = sum(xs[nextStart:nextEnd]) / count
+        avgY = sum(ys[nextStart:nextEnd]) / count
+
+        # pick the point in this bucket that makes the biggest triangle
+        start = int(i * bucketSize) + 1
+        end = int((i + 1) * bucketSize) + 1
+        bestArea = -1
+        best = start
+        for j in range(start, end):
+            area = abs((xs[a] - avgX) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avgY - ys[a]))
+            if area > bestArea:
+                bestArea = area
+                best = j
+        keep.append(best)
+        a = best
+
+    keep.append(n - 1)
+    return keep
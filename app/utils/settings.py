@@ -0,0 +1,31 @@
+# Settings like the MongoDB address and the Google login keys. Each one is looked for
+# in the environment variables first (that is how the production servers set them) and
+# only then in utils/secrets.py. secrets.py is only imported the first time a setting
+# isn't in the environment, so a server that has everything in its environment never
+# loads it at all.
+
+import os
+import threading
+
+_secrets = None
+_lock = threading.Lock()
+
+def loadSecrets():
+    global _secrets
+    if _secrets is None:
+        with _lock:
+            if _secrets is None:
+                try:
+                    from app.utils.secrets import getSecrets
+                except ModuleNotFoundError:
+                    # no secrets.py, everything has to be in the environment
+                    _secrets = {}
+                else:
+                    _secrets = getSecrets()
+    return _secrets
+
+def setting(name, default=None):
+    value = os.environ.get(name)
+    if value is not None:
+        return value
+    return loadSecrets().get(name, default)
@@ -0,0 +1,91 @@
+# The numbers on /sleep/stats: a student's average hours, rating, feel and minutes to
+# fall asleep for each week and each month, how much their bedtime moves around, and
+# their sleep debt (how many hours short of SLEEP_TARGET_HOURS they have slept, added
+# up). All of it comes from ONE aggregation pipeline. MongoDB reads the student's
+# sleeps with the (sleeper, sleep_date) index and does the adding up itself, so only
+# the few summary rows are sent back instead of every sleep.
+#
+# Bedtimes go past midnight, so the average of 11pm and 1am isn't noon. Each bedtime
+# is counted in minutes after NOON instead: 11pm is 660 and 1am is 780, and their
+# average is 720, which is midnight.
+
+import datetime as dt
+import math
+from app.classes.data import Sleep
+
+MS_PER_HOUR = 3600 * 1000
+MS_PER_DAY = 24 * MS_PER_HOUR
+
+# Hours asleep. Older sleeps saved the hours backwards (start - end) so they are
+# worked out again from start and end when both are there.
+HOURS = {'$ifNull': [{'$divide': [{'$subtract': ['$end', '$start']}, MS_PER_HOUR]}, '$hours']}
+# minutes after noon that the student went to bed
+BEDTIME = {'$mod': [{'$add': [{'$multiply': [{'$hour': '$start'}, 60]}, {'$minute': '$start'}, 720]}, 1440]}
+# the Sunday that starts the week of the sleep. (sleep_date is always midnight.)
+WEEK = {'$subtract': ['$sleep_date', {'$multiply': [{'$subtract': [{'$dayOfWeek': '$sleep_date'}, 1]}, MS_PER_DAY]}]}
+MONTH = {'year': {'$year': '$sleep_date'}, 'month': {'$month': '$sleep_date'}}
+
+def summary(target):
+    return {
+        'nights': {'$sum': 1},
+        'hours': {'$avg': '$hours'},
+        'rating': {'$avg': '$rating'},
+        'feel': {'$avg': '$feel'},
+        'minstosleep': {'$avg': '$minstosleep'},
+        'bedtime': {'$avg': '$bedtime'},
+        'bedtimeSquared': {'$avg': {'$multiply': ['$bedtime', '$bedtime']}},
+        'debt': {'$sum': {'$subtract': [target, '$hours']}},
+    }
+
+# How far bedtimes are from their average (the standard deviation), in minutes. It is
+# the square root of (average of the squares - square of the average). $stdDevPop does
+# the same thing but the in memory database (MONGO_IN_MEMORY) doesn't have it.
+SPREAD = {'$addFields': {'bedtimeSpread': {'$sqrt': {'$max': [0,
+    {'$subtract': ['$bedtimeSquared', {'$multiply': ['$bedtime', '$bedtime']}]}]}}}}
+
+def sleepStatsPipeline(sleeperID, since, target, weeks, months):
+    return [
+        {'$match': {'sleeper': sleeperID, 'sleep_date': {'$gte': since}}},
+        {'$project': {'sleep_date': 1, 'rating': 1, 'feel': 1, 'minstosleep': 1, 'hours': HOURS, 'bedtime': BEDTIME}},
+        {'$facet': {
+            'weekly': [{'$group': {'_id': WEEK, **summary(target)}}, SPREAD, {'$sort': {'_id': -1}}, {'$limit': weeks}],
+            'monthly': [{'$group': {'_id': MONTH, **summary(target)}}, SPREAD,
+                {'$sort': {'_id.year': -1, '_id.month': -1}}, {'$limit': months}],
+            'overall': [{'$group': {'_id': None, **summary(target)}}, SPREAD],
+        }},
+    ]
+
+# 780 minutes after noon is "1:00 am"
+def clockTime(minutesAfterNoon):
+    if minutesAfterNoon is None:
+        return None
+    minutes = round(minutesAfterNoon + 720) % 1440
+    return dt.time(minutes // 60, minutes % 60).strftime('%I:%M %p').lstrip('0').lower()
+
+def roundOrNone(value, digits=1):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return round(value, digits)
+
+def cleanRow(row):
+    hasBedtime = row.get('bedtime') is not None
+    return {
+        'nights': row['nights'],
+        'hours': roundOrNone(row.get('hours')),
+        'rating': roundOrNone(row.get('rating')),
+        'feel': roundOrNone(row.get('feel')),
+        'minstosleep': roundOrNone(row.get('minstosleep'), 0),
+        'bedtime': clockTime(row.get('bedtime')),
+        'bedtimeSpread': roundOrNone(row.get('bedtimeSpread'), 0) if hasBedtime else None,
+        'debt': roundOrNone(row.get('debt')),
+    }
+
+def sleepStats(sleeperID, target, weeks, months):
+    since = dt.datetime.combine(dt.date.today() - dt.timedelta(days=max(weeks * 7, months * 31)), dt.time())
+    result = next(Sleep.objects().aggregate(sleepStatsPipeline(sleeperID, since, target, weeks, months)), None) or {}
+    weekly = [dict(cleanRow(row), label=f"Week of {row['_id']:%b %d, %Y}") for row in result.get('weekly', [])]
+    monthly = [dict(cleanRow(row), label=dt.date(row['_id']['year'], row['_id']['month'], 1).strftime('%B %Y'))
+        for row in result.get('monthly', [])]
+    # (mongomock sends back a row of nothing when there are no sleeps, MongoDB doesn't)
+    overall = [cleanRow(row) for row in result.get('overall', []) if row['nights']]
+    return {'weekly': weekly, 'monthly': monthly, 'overall': overall[0] if overall else None, 'since': since}
@@ -0,0 +1,37 @@
+# The forum shows how many blogs have each tag. Counting them by scanning every blog
+# would get slower as the forum grows, so instead there is one TagCount document per
+# tag and 1 is added or taken away from it whenever a blog is saved, edited or deleted
+# (including the blogs deleted along with their author). countChangedTags below gets
+# those changes in the background. Reading the counts is one small indexed query.
+
+from app.classes.data import TagCount
+from app.utils.events import events
+
+# "Homework ", "homework" and "HOMEWORK" are all the same tag
+def normalizeTag(tag):
+    return ' '.join((tag or '').split()).lower()
+
+# Moves one blog from oldTag's count to newTag's. oldTag is None for a new blog and newTag is
+# None for a deleted blog. upsert=True makes the TagCount the first time a tag is used.
+def countTag(oldTag=None, newTag=None):
+    if oldTag == newTag:
+        return
+    if oldTag:
+        TagCount.objects(tag=oldTag).update_one(inc__count=-1)
+        # a tag that no blog uses anymore is removed so it doesn't show up with a 0
+        TagCount.objects(tag=oldTag, count__lte=0).delete()
+    if newTag:
+        TagCount.objects(tag=newTag).update_one(inc__count=1, upsert=True)
+
+# The most used tags, for the list of tags next to the blogs
+def topTags(size):
+    return list(TagCount.objects().order_by('-count').limit(size))
+
+# snapshot=True sends the blogs' tags from before and after each change
+@events.subscribe('Blog', fields=['tag'], snapshot=True)
+def countChangedTags(changes):
+    for change in changes:
+        before = {blog['_id']: blog.get('tag') for blog in change.before}
+        after = {blog['_id']: blog.get('tag') for blog in change.after}
+        for id in set(before) | set(after):
+            countTag(before.get(id), after.get(id))
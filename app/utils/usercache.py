@@ -0,0 +1,63 @@
+# Flask-Login asks for the logged in user at the start of EVERY request. Without a
+# cache that is a trip to MongoDB before the route even starts. This keeps the raw
+# user records of recently seen users in memory. Each request still gets its own
+# fresh User object built from the cached record so requests never share one object.
+#
+# Records are thrown away after USER_CACHE_TTL seconds and right away whenever a User
+# is saved, updated or deleted (see forgetChangedUsers below and utils/events.py).
+# Each app process has its own cache so the TTL is what keeps them from being stale
+# for long when another process changes a user.
+
+import threading
+import time
+from collections import OrderedDict
+from app import app
+from app.utils.events import events
+
+class UserCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, id):
+        key = str(id)
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[0] < time.monotonic():
+                self.items.pop(key, None)
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, id, record):
+        with self.lock:
+            self.items[str(id)] = (time.monotonic() + self.ttl, record)
+            self.items.move_to_end(str(id))
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def invalidate(self, id):
+        with self.lock:
+            self.items.pop(str(id), None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+userCache = UserCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+# sync=True so the very next request sees the change
+@events.subscribe('User', sync=True)
+def forgetChangedUsers(changes):
+    for change in changes:
+        if change.ids is None:
+            userCache.clear()
+        else:
+            for id in change.ids:
+                userCache.invalidate(id)
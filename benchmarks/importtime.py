@@ -0,0 +1,80 @@
+# How long does "import app" take? Every gunicorn worker and every flask command pays
+# this before it can do anything, so heavy libraries (matplotlib, oauthlib, requests,
+# Pillow) are only imported by the code that uses them. This checks that it stays
+# that way:
+#
+#   python benchmarks/importtime.py                 # from the top folder
+#   python benchmarks/importtime.py --budget 600 --runs 7
+#
+# It runs "python -X importtime -c 'import app'" in a new process several times and
+# takes the middle (median) time. It fails (exit code 1) if that is over the budget in
+# milliseconds, or if one of the libraries that should be lazy got imported anyway.
+# The slowest modules are listed to show where the time went.
+#
+# flask_moment imports distutils, and unless SETUPTOOLS_USE_DISTUTILS=stdlib is set
+# in the environment setuptools swaps in its own copy, which costs about 200 ms more.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# These must not be imported until a route needs them. (Pillow isn't on the list
+# because mongoengine itself imports it.)
+LAZY_MODULES = ['matplotlib', 'oauthlib', 'requests', 'setuptools', 'xmlrpc']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each line of -X importtime looks like
+# "import time:       self [us] | cumulative | imported package"
+def parseImportTime(stderr):
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        selfTime, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(selfTime), int(cumulative), len(name) - len(name.lstrip()))
+    return modules
+
+def measure():
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(f"import app failed:\n{result.stderr[-2000:]}")
+    return parseImportTime(result.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--budget', type=float, default=float(os.environ.get('IMPORT_BUDGET_MS', 1000)),
+        help="most milliseconds 'import app' may take (IMPORT_BUDGET_MS)")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='how many of the slowest modules to list')
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(args.runs)]
+    totals = [modules['app'][1] / 1000 for modules in runs]
+    median = statistics.median(totals)
+    last = runs[-1]
+
+    print(f"import app: median {median:.0f} ms, fastest {min(totals):.0f} ms, slowest {max(totals):.0f} ms over {args.runs} runs")
+    print(f"\nslowest top level imports (cumulative ms):")
+    # only the modules imported directly by app or at the top level, so time isn't counted twice
+    topLevel = [(name, times[1]) for name, times in last.items() if times[2] <= 3 and name != 'app']
+    for name, cumulative in sorted(topLevel, key=lambda item: -item[1])[:args.top]:
+        print(f"  {cumulative / 1000:8.1f}  {name}")
+
+    failed = False
+    eager = sorted(name for name in LAZY_MODULES if name in last)
+    if eager:
+        print(f"\nFAIL: these should only be imported when they are used: {', '.join(eager)}")
+        failed = True
+    if median > args.budget:
+        print(f"\nFAIL: import app took {median:.0f} ms, the budget is {args.budget:.0f} ms")
+        failed = True
+    if not failed:
+        print(f"\nOK: under the {args.budget:.0f} ms budget")
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+# How fast are the pages? This fills a MongoDB database with made up Users, Sleeps,
+# Blogs, Comments, Clinics and Responses and then asks for the busiest routes again
+# and again through Flask's test client, logged in as the made up users. For each
+# route it prints how long the requests took (the middle one p50, and the slowest 5%
+# and 1%, p95 and p99), how many requests a second that is, and how many queries each
+# request sent (the X-Query-Count header, see utils/querycount.py).
+#
+#   python benchmarks/routes.py                                  # from the top folder
+#   python benchmarks/routes.py --blogs 5000 --requests 500 --out before.json
+#   python benchmarks/routes.py --out after.json --compare before.json
+#
+# --out saves the results as JSON with the git commit they were measured on, so the
+# numbers from two commits can be compared with --compare.
+#
+# The data comes from utils/fixtures.py. The database is a local MongoDB
+# (mongodb://localhost:27017 unless MONGO_HOST or --host says otherwise). Its
+# collections are EMPTIED before the data is added, so the database name has to have
+# "bench" or "test" in it. --in-memory runs everything in memory with mongomock instead
+# (see MONGO_IN_MEMORY in app/__init__.py). That needs no server and several can run
+# at once, but mongomock doesn't tell pymongo's monitoring about queries so the
+# queries can't be counted (they show as n/a and are saved as null) and the timings
+# say nothing about MongoDB itself.
+
+import argparse
+import datetime as dt
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Time the busiest routes against made up data.')
+    parser.add_argument('--host', default=os.environ.get('MONGO_HOST', 'mongodb://localhost:27017'))
+    parser.add_argument('--in-memory', dest='inMemory', action='store_true', help='use mongomock instead of a MongoDB server')
+    parser.add_argument('--db', default='puzzles_bench', help='database to fill (it is emptied first)')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--sleeps', type=int, default=30, help='sleeps per user')
+    parser.add_argument('--blogs', type=int, default=500)
+    parser.add_argument('--comments', type=int, default=5, help='comments per blog')
+    parser.add_argument('--clinics', type=int, default=200)
+    parser.add_argument('--responses', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=3, help='puzzle sessions per user')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed requests per route first')
+    parser.add_argument('--routes', help='only these routes, separated by commas')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='show the change from the results in this JSON file')
+    return parser.parse_args()
+
+# The app connects to MONGO_HOST/MONGO_DB_NAME when it is imported, so these are set
+# first. See utils/settings.py
+def loadApp(args):
+    if args.inMemory:
+        os.environ['MONGO_IN_MEMORY'] = '1'
+    elif 'bench' not in args.db and 'test' not in args.db:
+        sys.exit(f"Refusing to empty the database {args.db!r}. Use a name with 'bench' or 'test' in it.")
+    else:
+        os.environ['MONGO_HOST'] = args.host
+    os.environ['MONGO_DB_NAME'] = args.db
+    # each process keeps its own timings, nothing is profiled and nothing is logged
+    os.environ.setdefault('PROFILE_SAMPLE_RATE', '0')
+    sys.path.insert(0, ROOT)
+    from app import app
+    app.config['WTF_CSRF_ENABLED'] = False
+    return app
+
+def seed(args):
+    from app.utils.fixtures import seedFixtures
+    from app.classes.data import ensureIndexes
+    counts = seedFixtures(users=args.users, sleeps=args.sleeps, blogs=args.blogs, comments=args.comments,
+        clinics=args.clinics, responses=args.responses, sessions=args.sessions, seed=args.seed)
+    if not args.inMemory:
+        ensureIndexes()
+    return counts['users'], counts['blogs']
+
+# One test client for each user so every request is made by a logged in student
+def loginClients(app, users, count=20):
+    clients = []
+    for user in users[:count]:
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+            session['_fresh'] = True
+        clients.append(client)
+    return clients
+
+# name: (method, how to make the url, the form to post or None)
+def routeCases(blogs):
+    from app.classes.puzzles import puzzleBank
+    puzzleSet = puzzleBank.sets['1']
+    answers = {f'a{i}': '2' for i in range(len(puzzleSet.questions))}
+    blogIDs = [str(blog.id) for blog in blogs]
+    return {
+        'blogList': ('GET', lambda rng: '/blogs' if rng.random() < 0.5 or not blogIDs else f"/blogs?after={rng.choice(blogIDs)}", None),
+        'blog': ('GET', lambda rng: f"/blog/{rng.choice(blogIDs)}", None),
+        'blogSearch': ('GET', lambda rng: f"/blogs/search?q={rng.choice(['sleep', 'music', 'homework books'])}", None),
+        'sleeps': ('GET', lambda rng: '/sleeps', None),
+        'sleepgraph': ('GET', lambda rng: '/sleepgraph', None),
+        'sleepgraphImage': ('GET', lambda rng: '/sleepgraph.png', None),
+        'sleepStats': ('GET', lambda rng: '/sleep/stats', None),
+        'clinicMap': ('GET', lambda rng: '/clinic/map', None),
+        # /response/new sends students to /puzzle/1, this answers it
+        'responseNew': ('POST', lambda rng: '/puzzle/1', answers),
+    }
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+# queries is None when they couldn't be counted
+def summarize(latencies, queries, statuses, elapsed):
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'queries_per_request': round(statistics.mean(queries), 2) if queries is not None else None,
+        'max_queries': max(queries) if queries is not None else None,
+        'errors': sum(1 for status in statuses if status >= 400),
+    }
+
+def timeRoute(clients, method, makeUrl, form, count, rng, countQueries=True):
+    latencies, queries, statuses = [], [], []
+    began = time.perf_counter()
+    for i in range(count):
+        client = clients[i % len(clients)]
+        url = makeUrl(rng)
+        start = time.perf_counter()
+        response = client.open(url, method=method, data=form)
+        latencies.append(time.perf_counter() - start)
+        queries.append(int(response.headers.get('X-Query-Count', 0)))
+        statuses.append(response.status_code)
+    return latencies, queries if countQueries else None, statuses, time.perf_counter() - began
+
+# load_user runs at the start of every logged in request. "cold" is a user that isn't
+# in the user cache yet so it has to be read from MongoDB.
+def timeLoadUser(app, users, count, rng):
+    from app.routes.login import load_user
+    from app.utils.usercache import userCache
+    results = {}
+    for name, cold in (('load_user', False), ('load_user_cold', True)):
+        latencies = []
+        began = time.perf_counter()
+        for _ in range(count):
+            userID = str(rng.choice(users).id)
+            if cold:
+                userCache.clear()
+            with app.test_request_context():
+                start = time.perf_counter()
+                load_user(userID)
+                latencies.append(time.perf_counter() - start)
+        results[name] = summarize(latencies, None, [200], time.perf_counter() - began)
+    return results
+
+def gitCommit():
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+def printResults(results, before=None):
+    print(f"{'route':<18}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'queries':>9}{'errors':>8}")
+    for name, row in results.items():
+        queries = 'n/a' if row['queries_per_request'] is None else f"{row['queries_per_request']:.1f}"
+        line = (f"{name:<18}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}"
+            f"{row['requests_per_second'] or 0:>10.0f}{queries:>9}{row['errors']:>8}")
+        old = (before or {}).get(name)
+        if old:
+            change = (row['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100 if old['p50_ms'] else 0
+            line += f"   p50 {change:+.0f}%"
+            # a run that couldn't count queries (--in-memory) has nothing to compare
+            if row['queries_per_request'] is not None and old.get('queries_per_request') is not None:
+                line += f", queries {row['queries_per_request'] - old['queries_per_request']:+.1f}"
+        print(line)
+
+def main():
+    args = parseArgs()
+    app = loadApp(args)
+    rng = random.Random(args.seed)
+
+    began = time.perf_counter()
+    users, blogs = seed(args)
+    print(f"Seeded {args.db} in {time.perf_counter() - began:.1f} s")
+    if not users or not blogs:
+        sys.exit('Need at least one user and one blog.')
+
+    clients = loginClients(app, users)
+    cases = routeCases(blogs)
+    wanted = set(args.routes.split(',')) if args.routes else None
+
+    results = {}
+    for name, (method, makeUrl, form) in cases.items():
+        if wanted and name not in wanted:
+            continue
+        timeRoute(clients, method, makeUrl, form, args.warmup, rng)
+        latencies, queries, statuses, elapsed = timeRoute(clients, method, makeUrl, form, args.requests, rng, not args.inMemory)
+        results[name] = summarize(latencies, queries, statuses, elapsed)
+    if not wanted or wanted & {'load_user', 'load_user_cold'}:
+        results.update(timeLoadUser(app, users, args.requests, rng))
+
+    before = None
+    if args.compare:
+        with open(args.compare) as file:
+            before = json.load(file)['results']
+    printResults(results, before)
+
+    if args.out:
+        report = {
+            'commit': gitCommit(),
+            'date': dt.datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'host': 'mongomock' if args.inMemory else args.host.split('://')[0],
+            'python': sys.version.split()[0],
+            'volumes': {key: getattr(args, key) for key in ('users', 'sleeps', 'blogs', 'comments', 'clinics', 'responses', 'sessions')},
+            'requests': args.requests,
+            'results': results,
+        }
+        with open(args.out, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Saved {args.out}")
+
+    # any route that answered with an error is a failure
+    if any(row['errors'] for row in results.values()):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# Settings for running the app in production with gunicorn (it is in requirements.txt):
+#
+#   gunicorn -c gunicorn.conf.py main:app
+#
+# main.py only starts Flask's debug server, which runs one process. gunicorn starts
+# several worker processes so the app can use every core, and each worker has a few
+# threads for requests that are waiting on MongoDB or Google.
+#
+# preload_app loads the app once in the main process and then fork()s the workers
+# from it, so the workers share that memory instead of each loading their own copy.
+# MongoDB connections must NOT be shared between processes, so the main process drops
+# its client before forking and every worker makes its own. See utils/database.py
+#
+# Everything here can be changed with environment variables.
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+os.environ.setdefault('OAUTHLIB_RELAX_TOKEN_SCOPE', '1')
+# Every worker keeps its own /metrics numbers and saves them in this folder so that
+# whichever worker answers /metrics can add them all up. See utils/metrics.py
+# It is emptied when gunicorn starts. Each gunicorn on the same machine needs its own.
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), f"puzzles-metrics-{os.getpid()}"))
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+# the usual rule of thumb is two workers per core plus one
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+preload_app = True
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+# restart each worker after this many requests (plus a random few so they don't all
+# restart at once) in case anything slowly leaks memory. 0 turns it off.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 200))
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+# Google only sends users back to https addresses. Usually a proxy in front of gunicorn
+# does https; set these to let gunicorn do it itself (like main.py does).
+certfile = os.environ.get('GUNICORN_CERTFILE') or None
+keyfile = os.environ.get('GUNICORN_KEYFILE') or None
+
+# In the main process after the app is loaded and before any worker is forked.
+# The indexes are built here, once per deploy: the text search, the clinic map's
+# 2dsphere index and the unique indexes that stop duplicate Google accounts and
+# puzzle sessions all depend on them. Building an index that is already there does
+# nothing. MONGO_ENSURE_INDEXES=0 skips this (then run 'flask ensure-indexes' yourself).
+# Building them opened connections, so start over with a client that hasn't connected
+# to anything.
+def when_ready(server):
+    from app import app
+    metricsDir = os.environ['METRICS_DIR']
+    shutil.rmtree(metricsDir, ignore_errors=True)
+    os.makedirs(metricsDir, exist_ok=True)
+    if os.environ.get('MONGO_ENSURE_INDEXES') != '0':
+        from app.classes.data import ensureIndexes
+        try:
+            ensureIndexes()
+            server.log.info("MongoDB indexes are up to date")
+        except Exception:
+            # like duplicate emails or Google ids that stop a unique index being built.
+            # The site still starts, but fix the data and run 'flask ensure-indexes'.
+            server.log.exception("Couldn't build the MongoDB indexes")
+        # the same check as 'flask explain-queries': every busy query should use an index
+        from app.cli import explainHotQueries
+        if not app.config['MONGO_IN_MEMORY']:
+            try:
+                for name, stages in explainHotQueries().items():
+                    if 'COLLSCAN' in stages:
+                        server.log.warning(f"This query reads the whole collection (COLLSCAN): {name}")
+            except Exception:
+                server.log.exception("Couldn't check the MongoDB query plans")
+    from app.utils.database import reconnectDB
+    reconnectDB()
+    # Caches kept in each worker's memory only hear about the changes made in that
+    # worker. The rendered list pages need to be shared, see utils/fragcache.py
+    if workers > 1 and not app.config['FRAGMENT_CACHE_URL']:
+        server.log.warning(f"{workers} workers but FRAGMENT_CACHE_URL isn't set. Each worker caches the list "
+            f"pages itself and can show old ones for up to {app.config['FRAGMENT_CACHE_TTL']} seconds. "
+            "Set FRAGMENT_CACHE_URL=redis://... (or GUNICORN_WORKERS=1).")
+
+# In each new worker. It gets its own MongoClient that connects on its first query.
+def post_fork(server, worker):
+    from app.utils.database import reconnectDB
+    reconnectDB()
+
+# A worker that is stopping (like after max_requests) saves its numbers one last time
+# so /metrics still counts its requests.
+def worker_exit(server, worker):
+    from app.utils.metrics import registry
+    if registry.directory:
+        registry.save()
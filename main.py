@@ -2,6 +2,8 @@
 from app import app
 import os
 
+# This runs the debug server for working on the site. To run it for real use gunicorn,
+# see gunicorn.conf.py
 if __name__ == "__main__":
     
     os.environ['OAUTHLIB_RELAX_TOKEN_SCOPE'] = '1'
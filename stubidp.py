@@ -0,0 +1,64 @@
+# A pretend Google login server for testing on your own computer. It lets you log in
+# as any email address without a Google account or internet connection.
+#
+# 1) Run this file: python stubidp.py    (it listens on http://127.0.0.1:5001)
+# 2) In secrets.py set GOOGLE_DISCOVERY_URL to
+#        http://127.0.0.1:5001/.well-known/openid-configuration
+# 3) The oauth library refuses to talk to a server without https unless you set
+#    OAUTHLIB_INSECURE_TRANSPORT=1 before you run main.py. NEVER set this on a real server.
+
+from flask import Flask, request, redirect, jsonify
+from urllib.parse import urlencode
+
+stub = Flask(__name__)
+base = "http://127.0.0.1:5001"
+
+@stub.route('/.well-known/openid-configuration')
+def discovery():
+    return jsonify(
+        issuer = base,
+        authorization_endpoint = base + "/authorize",
+        token_endpoint = base + "/token",
+        userinfo_endpoint = base + "/userinfo"
+    )
+
+# Instead of a Google login page you just type the email you want to be
+@stub.route('/authorize', methods=['GET', 'POST'])
+def authorize():
+    if request.method == 'POST':
+        params = {'code': request.form['email']}
+        if request.args.get('state'):
+            params['state'] = request.args['state']
+        return redirect(request.args['redirect_uri'] + "?" + urlencode(params))
+    return f"""
+        <form method="post" action="/authorize?{request.query_string.decode()}">
+            Log in as: <input name="email" value="student@ousd.org">
+            <input type="submit" value="Login">
+        </form>"""
+
+# The "code" and the "token" are both just the email address
+@stub.route('/token', methods=['POST'])
+def token():
+    return jsonify(
+        access_token = request.form['code'],
+        token_type = "Bearer",
+        expires_in = 3600,
+        scope = "openid email profile"
+    )
+
+@stub.route('/userinfo')
+def userinfo():
+    email = request.headers.get('Authorization', '').replace('Bearer ', '')
+    name = email.split('@')[0]
+    return jsonify(
+        sub = "stub-" + email,
+        name = name.upper(),
+        given_name = name.title(),
+        family_name = "Tester",
+        picture = base + "/picture.png",
+        email = email,
+        email_verified = True
+    )
+
+if __name__ == "__main__":
+    stub.run(port=5001)